@@ -22,23 +22,50 @@
 import os
 import sys
 import glob
+import csv
+import json
+import time
+import random
+import multiprocessing
 import polib
 from optparse import OptionParser
 import uuid
-from common import Settings, check_output
+from common import Settings, check_output, iter_po, po_stats, to_pofile
 
 
 def parse_arguments(arguments):
-    usage = 'check-translation.py -m <module> -l <lang>'
+    usage = ('check-translation.py -m <module> -l <lang>\n'
+        '       check-translation.py --all [--format json|csv]')
     parser = OptionParser(usage=usage)
     parser.add_option('-m', '--module', dest='module')
     parser.add_option('-l', '--lang', dest='lang')
+    parser.add_option('-a', '--all', dest='all', action='store_true',
+        default=False, help='Report coverage of all modules and languages')
+    parser.add_option('-f', '--format', dest='format', default='json',
+        choices=('json', 'csv'), help='Coverage output format: json or csv')
+    parser.add_option('-o', '--output', dest='output',
+        help='Coverage output file, stdout by default')
+    parser.add_option('', '--cache', dest='cache',
+        default='.check-translation.cache',
+        help='File where per file statistics are cached')
+    parser.add_option('', '--benchmark', dest='benchmark', type='int',
+        help='Compare polib and the streaming reader on a synthetic PO file '
+        'with this number of entries')
 
     (option, arguments) = parser.parse_args(arguments)
 
     settings = Settings()
+    settings.benchmark = option.benchmark
+    settings.all = option.all
+    settings.format = option.format
+    settings.output = option.output
+    settings.cache = option.cache
+    settings.module = option.module
+    settings.lang = option.lang
 
-    if option.module and option.lang:
+    if option.benchmark or option.all:
+        pass
+    elif option.module and option.lang:
         settings.module = option.module
         settings.lang = option.lang
     else:
@@ -46,23 +73,176 @@ def parse_arguments(arguments):
     return settings
 
 def check_translation(file_name):
-    po = polib.POFile(file_name)
-    print "  * Percentage Translated: ", po.percent_translated()
-    untranslated = po.untranslated_entries()
-    if untranslated:
+    stats = po_stats(file_name)
+    print "  * Percentage Translated: ", (stats['translated'] * 100
+        // stats['total'] if stats['total'] else 100)
+    if stats['untranslated']:
         print "  * Untranslated terms ------------------"
-        for entry in untranslated:
-            print "   ", entry.msgid
+        for entry in iter_po(file_name):
+            if (entry.msgid and not entry.obsolete and not entry.fuzzy
+                    and not entry.translated()):
+                print "   ", entry.msgid
 
-    fuzzy = po.fuzzy_entries()
-    if fuzzy:
+    if stats['fuzzy']:
         print "  * Fuzzy terms ------------------"
-        for entry in fuzzy:
-            print "   ", entry.msgid
+        header = True
+        for entry in iter_po(file_name):
+            if entry.obsolete:
+                continue
+            # The header entry is usually fuzzy, skip it as po_stats does
+            if header and entry._msgid == '':
+                header = False
+                continue
+            if entry.fuzzy:
+                print "   ", entry.msgid
+
+
+def _file_stats(file_name):
+    return file_name, po_stats(file_name)
+
+
+def coverage(modules_dir, cache_file, module=None, lang=None):
+    '''
+    Returns the statistics of every modules/<module>/locale/<lang>.po file as
+    a list of (module, lang, stats) sorted by module and language.
+
+    Statistics are cached by (path, mtime, size) in cache_file, so only new
+    or changed files are parsed, in parallel.
+    '''
+    cache = {}
+    if os.path.exists(cache_file):
+        try:
+            with open(cache_file, 'r') as f:
+                cache = json.load(f)
+        except ValueError:
+            pass
+
+    files = {}
+    changed = []
+    for file_name in glob.glob(os.path.join(modules_dir, module or '*',
+                'locale', (lang or '*') + '.po')):
+        stat = os.stat(file_name)
+        key = [stat.st_mtime, stat.st_size]
+        files[file_name] = key
+        cached = cache.get(file_name)
+        if not cached or cached['key'] != key:
+            changed.append(file_name)
+
+    if changed:
+        pool = multiprocessing.Pool()
+        try:
+            for file_name, stats in pool.imap_unordered(_file_stats,
+                    changed):
+                cache[file_name] = {
+                    'key': files[file_name],
+                    'stats': stats,
+                    }
+        finally:
+            pool.close()
+            pool.join()
+
+    stale = [x for x in cache if not x in files and not os.path.exists(x)]
+    if changed or stale:
+        for file_name in stale:
+            del cache[file_name]
+        with open(cache_file + '.tmp', 'w') as f:
+            json.dump(cache, f)
+        os.rename(cache_file + '.tmp', cache_file)
+
+    result = []
+    for file_name in files:
+        path, po = os.path.split(file_name)
+        result.append((os.path.basename(os.path.dirname(path)), po[:-3],
+                cache[file_name]['stats']))
+    return sorted(result)
+
+
+def write_coverage(result, format, output):
+    if format == 'csv':
+        writer = csv.writer(output)
+        writer.writerow(['module', 'lang', 'total', 'translated', 'fuzzy',
+                'untranslated', 'obsolete'])
+        for module, lang, stats in result:
+            writer.writerow([module, lang, stats['total'],
+                    stats['translated'], stats['fuzzy'],
+                    stats['untranslated'], stats['obsolete']])
+    else:
+        matrix = {}
+        for module, lang, stats in result:
+            matrix.setdefault(module, {})[lang] = stats
+        json.dump(matrix, output, indent=2, sort_keys=True)
+        output.write('\n')
+
+
+def benchmark(size):
+    '''
+    Writes a synthetic PO file with size entries and compares parsing it
+    with polib, the streaming reader and the stats only path. Also checks
+    that the reader round-trips byte for byte through polib.
+    '''
+    words = [u'Invoice', u'Party', u'"Sale"', u'line\nbreak', u'tab\t',
+        u'%(name)s', u'Caf\xe9', u'Account Move Line']
+    po = polib.POFile()
+    po.metadata = {
+        'Content-Type': 'text/plain; charset=utf-8',
+        }
+    for i in xrange(size):
+        text = u' '.join(random.choice(words)
+            for _ in xrange(random.randint(1, 20)))
+        entry = polib.POEntry(msgctxt=u'field:model.%d,name:' % i,
+            msgid=u'%s %d' % (text, i),
+            msgstr=random.choice([u'', text.upper()]))
+        if random.random() < 0.1:
+            entry.flags.append('fuzzy')
+        po.append(entry)
+    file_name = os.path.join('/tmp', str(uuid.uuid4())) + '.po'
+    po.save(file_name)
+
+    try:
+        start = time.time()
+        polib_po = polib.pofile(file_name)
+        polib_time = time.time() - start
+
+        start = time.time()
+        for entry in iter_po(file_name):
+            entry.msgid, entry.msgstr
+        reader_time = time.time() - start
+
+        start = time.time()
+        stats = po_stats(file_name)
+        stats_time = time.time() - start
+
+        print "* %d entries, %d KB" % (size,
+            os.path.getsize(file_name) // 1024)
+        print "  * polib.pofile:      %.2fs" % polib_time
+        print "  * iter_po:           %.2fs" % reader_time
+        print "  * po_stats:          %.2fs" % stats_time
+        print "  * Same statistics:  ", (stats['translated'] ==
+            len(polib_po.translated_entries()) and stats['fuzzy'] ==
+            len(polib_po.fuzzy_entries()))
+        print "  * Byte round-trip:  ", (unicode(to_pofile(file_name)) ==
+            unicode(polib_po))
+    finally:
+        os.remove(file_name)
 
 if __name__ == "__main__":
     settings = parse_arguments(sys.argv[1:])
 
+    if settings.benchmark:
+        benchmark(settings.benchmark)
+        sys.exit(0)
+
+    if settings.all:
+        result = coverage(os.path.join(os.getcwd(), 'modules'),
+            settings.cache, settings.module, settings.lang)
+        output = open(settings.output, 'w') if settings.output else sys.stdout
+        try:
+            write_coverage(result, settings.format, output)
+        finally:
+            if settings.output:
+                output.close()
+        sys.exit(0)
+
     print "* Check translation for module:", settings.module
     locale_dir = os.path.join(os.getcwd(), 'modules', settings.module,
         'locale')
@@ -21,12 +21,21 @@
 import warnings
 import sys
 import os
+import time
+import atexit
+import shutil
+import hashlib
 import optparse
 import logging
+import ConfigParser
+from xml.etree import ElementTree
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 
 def parse_arguments(arguments):
-    parser = optparse.OptionParser(usage='xmls-create.py [options] module')
+    parser = optparse.OptionParser(
+        usage='xmls-create.py [options] module [module ...]|all')
     parser.add_option('', '--trytond-dir', dest='trytond_dir',
             help='set trytond directory')
     parser.add_option('', '--stdout', action='store_true', dest='stdout',
@@ -35,6 +44,17 @@ def parse_arguments(arguments):
             help='Filter only this model')
     parser.add_option('-v', '--verbose', action='store_true', dest='verbose',
             help='Print more verbose log messages', default=False)
+    parser.add_option('', '--cache-dir', dest='cache_dir',
+            default='.create-xmls-cache',
+            help='Directory where installed test databases are cached')
+    parser.add_option('', '--no-cache', action='store_false', dest='cache',
+            help='Always install modules in a new database', default=True)
+    parser.add_option('-i', '--incremental', action='store_true',
+            dest='incremental', default=False,
+            help='Only add the fields and records missing in existing files')
+    parser.add_option('-j', '--jobs', dest='jobs', type='int',
+            default=multiprocessing.cpu_count(),
+            help='Number of modules generated at the same time')
     (option, arguments) = parser.parse_args(arguments)
 
     # Remove first argument because it's application name
@@ -58,15 +78,129 @@ def parse_arguments(arguments):
 
     if not arguments:
         parser.error("module is required")
-    module_name = arguments.pop(0)
+    if arguments == ['all']:
+        arguments = sorted(x for x in os.listdir('modules')
+            if os.path.exists(os.path.join('modules', x, 'tryton.cfg')))
+    option.cache_dir = os.path.abspath(option.cache_dir)
+
+    return option, arguments
+
+
+def module_directory(name):
+    import trytond
+    trytond_dir = os.path.dirname(os.path.abspath(trytond.__file__))
+    for path in (os.path.join(trytond_dir, 'modules', name),
+            os.path.join('modules', name),
+            os.path.join(trytond_dir, name)):
+        if os.path.isdir(path):
+            return path
+
+
+def module_dependencies(name, result=None):
+    '''
+    Returns the set of name and all the modules it depends on according to
+    the tryton.cfg files.
+    '''
+    if result is None:
+        result = set(['ir', 'res'])
+    result.add(name)
+    path = module_directory(name)
+    if not path or not os.path.exists(os.path.join(path, 'tryton.cfg')):
+        return result
+    config = ConfigParser.ConfigParser()
+    config.read(os.path.join(path, 'tryton.cfg'))
+    if config.has_option('tryton', 'depends'):
+        for depend in config.get('tryton', 'depends').split():
+            if depend not in result:
+                module_dependencies(depend, result)
+    return result
+
+
+def sources_hash(module_names):
+    '''
+    Returns a digest of the trytond version and the python, XML and cfg
+    files of module_names and their dependencies. The tests directories are
+    skipped as this script writes its output there.
+    '''
+    import trytond
+    names = set()
+    for name in module_names:
+        module_dependencies(name, names)
+    digest = hashlib.md5(trytond.__version__)
+    for name in sorted(names | set(['ir', 'res'])):
+        path = module_directory(name)
+        if not path:
+            continue
+        for dirpath, dirnames, filenames in os.walk(path, followlinks=True):
+            if 'tests' in dirnames:
+                dirnames.remove('tests')
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if not filename.endswith(('.py', '.xml', '.cfg')):
+                    continue
+                filename = os.path.join(dirpath, filename)
+                digest.update(name + os.path.relpath(filename, path))
+                with open(filename, 'rb') as f:
+                    digest.update(f.read())
+    return digest.hexdigest()
+
+
+def setup_database_cache(module_names):
+    '''
+    Makes trytond use a SQLite file in the cache directory as test database.
+    If a database installed from the same sources was cached it is copied
+    as the working database. Returns the cache filename to store the
+    database in after installing, or None if it was restored.
+    '''
+    from trytond.config import config as CONFIG
+
+    if not os.path.isdir(options.cache_dir):
+        os.makedirs(options.cache_dir)
+    if len(module_names) == 1:
+        prefix = module_names[0]
+    else:
+        prefix = 'batch_%s' % hashlib.md5(','.join(sorted(module_names))
+            ).hexdigest()[:8]
+    cache_file = os.path.join(options.cache_dir, '%s-%s.sqlite' % (prefix,
+            sources_hash(module_names)))
+    db_name = 'create-xmls-%d' % os.getpid()
+    db_file = os.path.join(options.cache_dir, db_name + '.sqlite')
+    atexit.register(lambda: os.path.exists(db_file) and os.remove(db_file))
+
+    CONFIG.set('database', 'uri', 'sqlite://')
+    CONFIG.set('database', 'path', options.cache_dir)
+    os.environ['DB_NAME'] = db_name
+    if os.path.exists(cache_file):
+        logger.info("Using cached database %s" % cache_file)
+        shutil.copyfile(cache_file, db_file)
+        return None
+    return cache_file
+
+
+def store_database_cache(cache_file):
+    '''
+    Copies the installed working database to cache_file and removes the
+    databases cached for older sources.
+    '''
+    prefix = os.path.basename(cache_file).rsplit('-', 1)[0]
+    for filename in os.listdir(options.cache_dir):
+        if (filename.endswith('.sqlite')
+                and filename.rsplit('-', 1)[0] == prefix):
+            os.remove(os.path.join(options.cache_dir, filename))
+    db_file = os.path.join(options.cache_dir, DB_NAME + '.sqlite')
+    shutil.copyfile(db_file, cache_file + '.tmp')
+    os.rename(cache_file + '.tmp', cache_file)
+    logger.info("Database cached in %s" % cache_file)
 
-    return option, module_name
 
 logger = logging.getLogger('create_xmls')
-options, module_name = parse_arguments(sys.argv)
-
+options, module_names = parse_arguments(sys.argv)
 
-os.environ['DB_NAME'] = ':memory:'
+cache_file = None
+if options.cache:
+    cache_file = setup_database_cache(module_names)
+else:
+    os.environ['DB_NAME'] = ':memory:'
 import trytond.tests.test_tryton
 from trytond.tests.test_tryton import DB_NAME, USER, CONTEXT
 from trytond.transaction import Transaction
@@ -74,50 +208,35 @@ from trytond.model import ModelView, ModelSQL
 from trytond.pool import Pool
 
 
-def write_view_file(filename, view):
-    if options.stdout:
-        print view
-        return
-
-    if not os.path.exists('view'):
-        os.mkdir('view')
-
-    f = open(os.path.join('view', filename), 'w')
-    try:
-        f.write(view)
-    finally:
-        f.close()
-
-
 def generate_tree_view(module_name, model_name, description, inherit_type,
-        inherit, fields):
+        inherit, fields, views):
     inherit_tag = ''
-    arch = '''\
+    arch = ['''\
 <?xml version="1.0"?>
 <!-- The COPYRIGHT file at the top level of this repository contains the full
-     copyright notices and license terms. -->'''
+     copyright notices and license terms. -->''']
 
     tabs = "    "
     if inherit_type and inherit_type == 'extends':
         inherit_tag = '\n\
         <!-- TODO fill "ref" attribute with inherited view of model %s -->\n\
             <field name="inherit" ref=""/>' % inherit
-        arch += '\n<data>'
-        arch += '\n<!-- TODO fill "xpath expr" -->\
-                \n    <xpath expr="" position="before">'
+        arch.append('\n<data>')
+        arch.append('\n<!-- TODO fill "xpath expr" -->\
+                \n    <xpath expr="" position="before">')
         tabs += "    "
     else:
-        arch += '\n<tree string="%s">' % description
+        arch.append('\n<tree string="%s">' % description)
         if inherit:
-            arch += '\n<!-- TODO add %s model(s) fields -->' % inherit
+            arch.append('\n<!-- TODO add %s model(s) fields -->' % inherit)
 
     for fieldname in fields:
-        arch += '\n%s<field name="%s"/>' % (tabs, fieldname)
+        arch.append('\n%s<field name="%s"/>' % (tabs, fieldname))
     if inherit_type and inherit_type == 'extends':
-        arch += '\n    </xpath>'
-        arch += '\n</data>'
+        arch.append('\n    </xpath>')
+        arch.append('\n</data>')
     else:
-        arch += '\n</tree>'
+        arch.append('\n</tree>')
 
     id = model_name.replace('.', '_')
     view_file = "%s_list.xml" % id
@@ -127,43 +246,43 @@ def generate_tree_view(module_name, model_name, description, inherit_type,
             <field name="type">tree</field>%s
             <field name="name">%s_list</field>
         </record>""" % (id, model_name, inherit_tag, id)
-    write_view_file(view_file, arch)
+    views[view_file] = (''.join(arch), fields)
     return output
 
 
 def generate_form_view(module_name, model_name, description, inherit_type,
-        inherit, fields):
+        inherit, fields, views):
 
     inherit_tag = ''
-    arch = '''\
+    arch = ['''\
 <?xml version="1.0"?>
 <!-- The COPYRIGHT file at the top level of this repository contains the full
-     copyright notices and license terms. -->'''
+     copyright notices and license terms. -->''']
 
     tabs = "    "
     if inherit_type and inherit_type == 'extends':
         inherit_tag = '\n\
         <!-- TODO fill "ref" attribute with inherited view of model %s -->\n\
             <field name="inherit" ref=""/>' % inherit
-        arch += '\n<data>'
-        arch += '\n<!-- TODO fill "xpath expr" -->\
-                \n    <xpath expr="" position="before">'
+        arch.append('\n<data>')
+        arch.append('\n<!-- TODO fill "xpath expr" -->\
+                \n    <xpath expr="" position="before">')
         tabs += "    "
     else:
-        arch += '\n<form string="%s">' % description
+        arch.append('\n<form string="%s">' % description)
         if inherit:
-            arch += (
+            arch.append(
                 '\n <!-- TODO add %s model(s) fields -->'
                 % inherit)
 
     for fieldname in fields:
-        arch += '\n%s<label name="%s"/>' % (tabs, fieldname)
-        arch += '\n%s<field name="%s"/>' % (tabs, fieldname)
+        arch.append('\n%s<label name="%s"/>' % (tabs, fieldname))
+        arch.append('\n%s<field name="%s"/>' % (tabs, fieldname))
     if inherit_type and inherit_type == 'extends':
-        arch += '\n    </xpath>'
-        arch += '\n</data>'
+        arch.append('\n    </xpath>')
+        arch.append('\n</data>')
     else:
-        arch += '\n</form>'
+        arch.append('\n</form>')
 
     id = model_name.replace('.', '_')
     view_file = "%s_form.xml" % id
@@ -174,7 +293,7 @@ def generate_form_view(module_name, model_name, description, inherit_type,
             <field name="name">%s_form</field>
         </record>""" % (id, model_name, inherit_tag, id)
 
-    write_view_file(view_file, arch)
+    views[view_file] = (''.join(arch), fields)
     return output
 
 
@@ -254,153 +373,321 @@ def generate_access(module_name, model_name):
     return output
 
 
-def generate_menus(module_name, model):
-    id = model.model.replace('.', '_')
+def generate_menus(module_name, model_name, description):
+    id = model_name.replace('.', '_')
     output = ('        <menuitem action="act_%s" id="menu_%s" parent="menu_%s"'
-        ' sequence="1" name="%s"/>\n' % (id, id, module_name, model.name))
+        ' sequence="1" name="%s"/>\n' % (id, id, module_name, description))
     return output
 
 
-def create_xml(filename, module_name, model_names):
-    output = '''\
+def create_xml(filename, module_name, model_names, index, views):
+    output = ['''\
 <?xml version="1.0" encoding="utf-8"?>
 <!-- The COPYRIGHT file at the top level of this repository contains the full
-     copyright notices and license terms. -->\n'''
-    output += '<tryton>\n'
-    output += '    <data>\n'
-    menus_output = ''
+     copyright notices and license terms. -->\n''']
+    output.append('<tryton>\n')
+    output.append('    <data>\n')
+    menus_output = []
     if len(model_names) > 0:
-        output += generate_users(module_name)
-    with Transaction().start(DB_NAME, USER, context=CONTEXT):
-        pool = Pool()
-        Model = pool.get('ir.model')
-        Fields = pool.get('ir.model.field')
-        models = Model.search([('module', '=', module_name)])
-        company_models = []
-        for model in models:
-            if not model.model in model_names:
-                continue
-            if '-' in model.model:
-                continue
-            Class = pool.get(model.model)
-            if not issubclass(Class, ModelView):
-                continue
-            fields = Class._fields.keys()
-            fields = sorted(list(set(fields) - set(['id', 'create_uid',
-                        'create_date', 'write_uid', 'write_date',
-                                                    'rec_name'])))
-            output += generate_form_view(module_name, model.model,
-                model.name, None, None, fields)
-            output += generate_tree_view(module_name, model.model,
-                model.name, None, None, fields)
-            output += generate_action(model.model, model.name)
-            if issubclass(Class, ModelSQL):
-                output += generate_access(module_name, model.model)
-                menus_output += generate_menus(module_name, model)
-            if 'company' in fields:
-                company_models.append(model.model)
-        fields = Fields.search([
-                ('module', '=', module_name),
-                ('model', 'not in', models),
-            ])
-        inherited_models = {}
-        for field in fields:
-            Class = pool.get(field.model.model)
-            model = field.model
-            if model in inherited_models:
-                inherited_models[model].append(field.name)
-            else:
-                inherited_models[model] = [field.name]
-        for model, fields in inherited_models.iteritems():
-            output += generate_form_view(module_name, model.model,
-                model.name, 'extends', model.model, fields)
-            output += generate_tree_view(module_name, model.model,
-                model.name, 'extends', model.model, fields)
+        output.append(generate_users(module_name))
+    company_models = []
+    for model_name, description, Class in index[module_name]['models']:
+        if not model_name in model_names:
+            continue
+        if '-' in model_name:
+            continue
+        if not issubclass(Class, ModelView):
+            continue
+        fields = Class._fields.keys()
+        fields = sorted(list(set(fields) - set(['id', 'create_uid',
+                    'create_date', 'write_uid', 'write_date',
+                                                'rec_name'])))
+        output.append(generate_form_view(module_name, model_name,
+            description, None, None, fields, views))
+        output.append(generate_tree_view(module_name, model_name,
+            description, None, None, fields, views))
+        output.append(generate_action(model_name, description))
+        if issubclass(Class, ModelSQL):
+            output.append(generate_access(module_name, model_name))
+            menus_output.append(generate_menus(module_name, model_name,
+                description))
+        if 'company' in fields:
+            company_models.append(model_name)
+    for (model_name, description), fields in (
+            index[module_name]['inherited'].iteritems()):
+        output.append(generate_form_view(module_name, model_name,
+            description, 'extends', model_name, fields, views))
+        output.append(generate_tree_view(module_name, model_name,
+            description, 'extends', model_name, fields, views))
     for model in company_models:
-        output += '\n'
-        output += '''
+        output.append('\n')
+        output.append('''
           <record model="ir.rule.group" id="rule_group_%s">
             <field name="model" search="[('model', '=', '%s')]"/>
             <field name="global_p" eval="True"/>
           </record>
-          ''' % (model.replace('.', '_'), model)
-        output += '''
+          ''' % (model.replace('.', '_'), model))
+        output.append('''
           <record model="ir.rule" id="rule_%s1">
             <field name="domain">
                 [('company', '=', user.company.id if user.company else None)]
             </field>
             <field name="rule_group" ref="rule_group_%s"/>
           </record>
-          ''' % (model.replace('.', '_'), model.replace('.', '_'))
-        output += '\n'
+          ''' % (model.replace('.', '_'), model.replace('.', '_')))
+        output.append('\n')
 
-    output += '\n'
+    output.append('\n')
     if menus_output:
-        output += '        <!-- Menus -->\n'
-        output += ('        <menuitem id="menu_%s" name="%s" sequence="1" />\n'
+        output.append('        <!-- Menus -->\n')
+        output.append(
+            '        <menuitem id="menu_%s" name="%s" sequence="1" />\n'
             % (module_name, module_name.capitalize()))
-        output += '''
+        output.append('''
           <record model="ir.ui.menu-res.group" id="menu_%s_group_%s">
             <field name="menu" ref="menu_%s"/>
             <field name="group" ref="group_%s"/>
           </record>
-          ''' % (module_name, module_name, module_name, module_name)
-        output += '''
+          ''' % (module_name, module_name, module_name, module_name))
+        output.append('''
           <record model="ir.ui.menu-res.group" id="menu_%s_group_%s_admin">
             <field name="menu" ref="menu_%s"/>
             <field name="group" ref="group_%s"/>
           </record>
-          ''' % (module_name, module_name, module_name, module_name)
-        output += '\n'
-        output += menus_output
-    output += '    </data>\n'
-    output += '</tryton>'
-    return output
-
-
-def get_python_files(module_name):
-    files = {}
+          ''' % (module_name, module_name, module_name, module_name))
+        output.append('\n')
+        output.extend(menus_output)
+    output.append('    </data>\n')
+    output.append('</tryton>')
+    return ''.join(output)
+
+
+def build_index(module_names):
+    '''
+    Reads in a single transaction the models and fields of all
+    module_names. Returns a dictionary per module with:
+
+        models: list of (model, description, class) of its models
+        inherited: {(model, description): [field names]} of the fields it
+            adds to models of other modules
+        files: {python file: [model names]} of its models
+    '''
+    index = dict((x, {
+                'models': [],
+                'inherited': {},
+                'files': {},
+                }) for x in module_names)
     with Transaction().start(DB_NAME, USER, context=CONTEXT):
         pool = Pool()
         Model = pool.get('ir.model')
-        models = Model.search([('module', '=', module_name)])
-        for model in models:
+        Fields = pool.get('ir.model.field')
+        for model in Model.search([('module', 'in', module_names)]):
+            module = index[model.module]
             Class = pool.get(model.model)
+            module['models'].append((model.model, model.name, Class))
             module_path = Class.__module__
             # Expected output
             # 'trytond.modules.<module_name>[.<subdir>].<model.model>
             filename = module_path.split('.')[-1]
-            if not filename.startswith(module_name):
-                filename = module_name + '_' + filename
-            files.setdefault(filename, []).append(Class.__name__)
-    return files
+            if not filename.startswith(model.module):
+                filename = model.module + '_' + filename
+            module['files'].setdefault(filename, []).append(Class.__name__)
+        for field in Fields.search([('module', 'in', module_names)]):
+            if field.model.module == field.module:
+                continue
+            index[field.module]['inherited'].setdefault(
+                (field.model.model, field.model.name), []).append(field.name)
+    return index
 
 
-if __name__ == '__main__':
-    warnings.filterwarnings(action='ignore', category=DeprecationWarning)
+def write_file(filename, content):
+    f = open(filename, 'w')
+    try:
+        f.write(content)
+    finally:
+        f.close()
 
-    logger.info("Generating XMLs for module '%s'" % module_name)
-    os.chdir(os.path.join('./modules/', module_name, 'tests'))
 
-    trytond.tests.test_tryton.install_module(module_name)
-    files = get_python_files(module_name)
-    logger.debug("Python files: %s" % files)
+def _insert_before(content, tag, lines):
+    '''
+    Inserts lines in content before the last closing tag, indented one
+    level more than it. Returns None if the tag is not found.
+    '''
+    position = content.rfind(tag)
+    if position < 0:
+        return None
+    line_start = content.rfind('\n', 0, position) + 1
+    indent = content[line_start:position]
+    if indent.strip():
+        # The closing tag is not alone in its line
+        return '%s\n%s\n%s' % (content[:position],
+            '\n'.join(lines), content[position:])
+    return '%s%s\n%s' % (content[:line_start],
+        '\n'.join(indent + '    ' + x for x in lines), content[line_start:])
+
+
+def patch_view(filename, fields):
+    '''
+    Adds to the view in filename the fields it does not reference yet,
+    before the end of its xpath or root element. Returns the names of the
+    added fields or None if the view could not be patched.
+    '''
+    with open(filename, 'r') as f:
+        content = f.read()
+    try:
+        root = ElementTree.fromstring(content)
+    except SyntaxError, e:
+        logger.warning('%s not patched: %s' % (filename, e))
+        return None
+    existing = set(x.get('name') for x in root.iter('field'))
+    missing = [x for x in fields if x not in existing]
+    if not missing:
+        return []
+    lines = []
+    for fieldname in missing:
+        if root.tag == 'form' or (root.tag == 'data'
+                and filename.endswith('_form.xml')):
+            lines.append('<label name="%s"/>' % fieldname)
+        lines.append('<field name="%s"/>' % fieldname)
+    tag = '</xpath>' if root.tag == 'data' else '</%s>' % root.tag
+    content = _insert_before(content, tag, lines)
+    if content is None:
+        logger.warning('%s not patched: %s not found' % (filename, tag))
+        return None
+    write_file(filename, content)
+    return missing
+
+
+def patch_xml(filename, output):
+    '''
+    Adds to the XML file the records and menu items of output whose id it
+    does not define yet. Returns the added ids or None if the file could
+    not be patched.
+    '''
+    with open(filename, 'r') as f:
+        content = f.read()
+    try:
+        existing = set(x.get('id') for x in
+            ElementTree.fromstring(content).iter() if x.get('id'))
+        generated = ElementTree.fromstring(output)
+    except SyntaxError, e:
+        logger.warning('%s not patched: %s' % (filename, e))
+        return None
+    missing = []
+    lines = []
+    for data in generated.findall('data'):
+        for element in data:
+            id = element.get('id')
+            if not id or id in existing:
+                continue
+            element.tail = None
+            missing.append(id)
+            lines.append(ElementTree.tostring(element, encoding='utf-8'))
+    if not missing:
+        return []
+    # The closing tag of data is indented one level more than its children
+    content = _insert_before(content, '</data>', lines)
+    if content is None:
+        logger.warning('%s not patched: </data> not found' % filename)
+        return None
+    write_file(filename, content)
+    return missing
+
+
+def save_file(filename, content, patch=None):
+    '''
+    Writes content to filename. In incremental mode existing files are
+    only patched calling patch(filename). Returns (status, added names).
+    '''
+    if not options.incremental or not os.path.exists(filename):
+        write_file(filename, content)
+        return ('added' if options.incremental else 'written'), []
+    added = patch(filename)
+    if added is None:
+        return 'skipped', []
+    return ('patched' if added else 'unchanged'), added
+
+
+def generate_module(args):
+    '''
+    Generates and writes the XML and view files of one module. Returns
+    (module, [(filename, status, added names)], seconds).
+    '''
+    module_name, index = args
+    start = time.time()
+    files = index[module_name]['files']
+    logger.debug("Python files of %s: %s" % (module_name, files))
     if len(files) == 0:
         files = {module_name: []}
-    for filename in files:
+    views = {}
+    outputs = []
+    for filename in sorted(files):
         models = files[filename]
         if options.model:
             if options.model in models:
                 models = [options.model]
             else:
                 models = []
-        output = create_xml(filename + '.xml', module_name, models)
-        if options.stdout:
+        outputs.append((filename + '.xml', create_xml(filename + '.xml',
+                    module_name, models, index, views)))
+
+    results = []
+    if options.stdout:
+        for filename in sorted(views):
+            print views[filename][0]
+        for filename, output in outputs:
             print output
-        else:
-            logger.info('\nWriting to %s.xml...\n' % filename)
-            f = open(filename + '.xml', 'w')
-            try:
-                f.write(output)
-            finally:
-                f.close()
+    else:
+        directory = os.path.join('modules', module_name, 'tests')
+        if views and not os.path.exists(os.path.join(directory, 'view')):
+            os.makedirs(os.path.join(directory, 'view'))
+        for filename, (view, fields) in sorted(views.iteritems()):
+            results.append((os.path.join('view', filename),) + save_file(
+                    os.path.join(directory, 'view', filename), view,
+                    lambda x: patch_view(x, fields)))
+        for filename, output in outputs:
+            logger.debug('Writing to %s...' % os.path.join(directory,
+                    filename))
+            results.append((filename,) + save_file(
+                    os.path.join(directory, filename), output,
+                    lambda x: patch_xml(x, output)))
+    return module_name, results, time.time() - start
+
+
+if __name__ == '__main__':
+    warnings.filterwarnings(action='ignore', category=DeprecationWarning)
+
+    start = time.time()
+    logger.info("Generating XMLs for modules: %s" % ', '.join(module_names))
+
+    # On a restored database the modules are already installed so this
+    # only initializes the pool
+    for module_name in module_names:
+        trytond.tests.test_tryton.install_module(module_name)
+    if cache_file:
+        store_database_cache(cache_file)
+    logger.info("Modules installed in %.2fs" % (time.time() - start))
+
+    index = build_index(module_names)
+    tasks = [(x, index) for x in module_names]
+    if options.stdout or options.jobs <= 1:
+        results = map(generate_module, tasks)
+    else:
+        pool = ThreadPool(min(options.jobs, len(tasks)))
+        try:
+            results = pool.map(generate_module, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    for module_name, files, seconds in sorted(results):
+        counts = {}
+        for filename, status, added in files:
+            counts[status] = counts.get(status, 0) + 1
+            if added:
+                logger.info("%s: %s: added %s" % (module_name, filename,
+                        ', '.join(added)))
+        logger.info("%s: %s in %.2fs" % (module_name,
+                ', '.join('%d %s' % (counts[x], x) for x in sorted(counts))
+                or 'nothing written', seconds))
+    logger.info("%d modules generated in %.2fs" % (len(module_names),
+            time.time() - start))
@@ -22,11 +22,20 @@
 from proteus import config, Wizard, Model
 import os
 import sys
+import time
+import polib
+import hashlib
+import itertools
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from common import Settings
 from optparse import OptionParser
 
 dest_path = 'modules/%s/locale'
 
+# Threads running the export wizard over XML-RPC, each one logs in
+EXPORT_THREADS = 4
+
 directory = os.path.abspath(os.path.normpath(os.path.join(os.getcwd(),
                     'trytond')))
 
@@ -35,13 +44,21 @@ if os.path.isdir(directory):
 
 
 def parse_arguments(arguments):
-    usage = 'export_translation.py  -d <database> -m <module> -l <lang>'
+    usage = ('export_translation.py  -d <database> -m <module> '
+        '-l <lang>[,<lang>...]|all')
     parser = OptionParser(usage=usage)
     parser.add_option('-u', '--url', dest='url')
     parser.add_option('-d', '--database', dest='database')
     parser.add_option('-m', '--module', dest='module')
     parser.add_option('-l', '--lang', dest='lang')
     parser.add_option('-p', '--path', dest='path')
+    parser.add_option('', '--bulk', dest='bulk', action='store_true',
+        default=False, help='Read all translations at once instead of '
+        'running the export wizard per module')
+    parser.add_option('-j', '--jobs', dest='jobs', type='int',
+        help='Number of processes writing PO files in bulk mode (number of '
+        'CPUs by default) or threads running the export wizard over XML-RPC '
+        '(%d by default)' % EXPORT_THREADS)
 
     (option, arguments) = parser.parse_args(arguments)
 
@@ -53,20 +70,246 @@ def parse_arguments(arguments):
         settings.lang = option.lang
         settings.url = option.url
         settings.path = option.path
+        settings.bulk = option.bulk
+        settings.jobs = option.jobs
     else:
         print usage
     return settings
 
-if __name__ == "__main__":
 
-    settings = parse_arguments(sys.argv[1:])
+def locale_path(base_path, module):
+    '''
+    Returns the locale directory of module or None if it does not exist.
+    '''
+    base_path = base_path if base_path else ''
+    path = os.path.join(base_path, dest_path % module)
+    if not os.path.exists(path):
+        path = os.path.join(base_path, module, 'locale')
+        if not os.path.exists(path):
+            print 'Path \'%s\' not found.' % path
+            return None
+    return path
+
+
+# Types exported even if the record they belong to has no fs_id
+NO_RECORD_TYPES = ('odt', 'view', 'wizard_button', 'selection', 'error')
+
+# Models whose model data also identifies records of another model
+EXTRA_MODEL_DATA = {
+    'ir.action.report': 'ir.action',
+    'ir.action.act_window': 'ir.action',
+    'ir.action.wizard': 'ir.action',
+    'ir.action.url': 'ir.action',
+    }
+
+
+def build_po(translations, fs_ids):
+    '''
+    Returns the content of the PO file of translations, a list of
+    ir.translation values of one module and language, the same way
+    ir.translation.export does. fs_ids maps model and database id to the
+    fs_id of the module. Returns None if there is nothing to export.
+    '''
+    entries = []
+    for translation in translations:
+        flags = ['fuzzy'] if translation['fuzzy'] else []
+        msgctxt = '%s:%s:' % (translation['type'], translation['name'])
+        res_id = translation['res_id']
+        if res_id >= 0:
+            model = translation['name'].split(',')[0]
+            if model not in fs_ids:
+                continue
+            res_id = fs_ids[model].get(res_id)
+            msgctxt += '%s' % (res_id or '')
+        if res_id or translation['type'] in NO_RECORD_TYPES:
+            entries.append(polib.POEntry(msgid=translation['src'] or '',
+                    msgstr=translation['value'] or '', msgctxt=msgctxt,
+                    flags=flags))
+    if not entries:
+        return None
+    pofile = polib.POFile(wrapwidth=78)
+    pofile.metadata = {
+        'Content-Type': 'text/plain; charset=utf-8',
+        }
+    entries.sort(key=lambda x: (x.msgctxt, x.msgid))
+    pofile.extend(entries)
+    return unicode(pofile).encode('utf-8')
+
+
+def save_po(filename, content):
+    '''
+    Writes content to filename unless the file already has the same
+    content. Returns 'written' or 'unchanged'.
+    '''
+    if os.path.exists(filename):
+        with open(filename, 'rb') as f:
+            if (hashlib.md5(f.read()).digest()
+                    == hashlib.md5(content).digest()):
+                return 'unchanged'
+    # Write and rename so an interrupted run never leaves a truncated file
+    with open(filename + '.tmp', 'wb') as f:
+        f.write(content)
+    os.rename(filename + '.tmp', filename)
+    return 'written'
 
+
+def _write_po(args):
+    '''
+    Worker: builds the PO file of one module and language and writes it
+    unless its content did not change. Returns (filename, status).
+    '''
+    filename, translations, fs_ids = args
+    content = build_po(translations, fs_ids)
+    if content is None:
+        return filename, 'empty'
+    return filename, save_po(filename, content)
+
+
+def _search_read(model, domain, fields):
+    Model_ = Model.get(model)
+    return Model_._proxy.search_read(domain, 0, None, None, fields,
+        Model_._config.context)
+
+
+def bulk_export(settings, modules, langs):
+    '''
+    Reads the translations of all modules and langs with a single call,
+    groups them by module and language and writes the PO files on a
+    process pool.
+    '''
+    start = time.time()
+    names = [x.name for x in modules]
+    fs_ids = {}
+    for data in _search_read('ir.model.data', [('module', 'in', names)],
+            ['module', 'model', 'db_id', 'fs_id']):
+        models = [data['model']]
+        if data['model'] in EXTRA_MODEL_DATA:
+            models.append(EXTRA_MODEL_DATA[data['model']])
+        for model in models:
+            fs_ids.setdefault(data['module'], {}).setdefault(model, {})[
+                data['db_id']] = data['fs_id']
+    translations = {}
+    for translation in _search_read('ir.translation', [
+                ('lang', 'in', langs),
+                ('module', 'in', names),
+                ], ['lang', 'module', 'type', 'name', 'res_id', 'src',
+                'value', 'fuzzy']):
+        translations.setdefault((translation['module'], translation['lang']),
+            []).append(translation)
+    print '%d translations read in %.2fs' % (
+        sum(len(x) for x in translations.itervalues()), time.time() - start)
+
+    tasks = []
+    for name in names:
+        path = locale_path(settings.path, name)
+        if not path:
+            continue
+        for lang in langs:
+            if (name, lang) in translations:
+                tasks.append((os.path.join(path, '%s.po' % lang),
+                        translations.pop((name, lang)),
+                        fs_ids.get(name, {})))
+
+    counts = {}
+    pool = multiprocessing.Pool(settings.jobs or multiprocessing.cpu_count())
+    try:
+        for filename, status in pool.imap_unordered(_write_po, tasks):
+            counts[status] = counts.get(status, 0) + 1
+            if status == 'written':
+                print '\'%s\' exported successfully.' % filename
+    finally:
+        pool.close()
+        pool.join()
+    print '%d files written, %d unchanged, %d empty in %.2fs' % (
+        counts.get('written', 0), counts.get('unchanged', 0),
+        counts.get('empty', 0), time.time() - start)
+
+
+def connect(settings):
     if settings.database:
         config.set_trytond(
             database=settings.database)
     else:
         config.set_xmlrpc(settings.url)
 
+
+def _export(task):
+    '''
+    Worker: runs the export wizard for one module and language. Returns
+    (module, lang, status, seconds).
+    '''
+    module_id, module_name, lang_id, lang_code, filename = task
+    start = time.time()
+    try:
+        translation_export = Wizard('ir.translation.export')
+        translation_export.form.language = Model.get('ir.lang')(lang_id)
+        translation_export.form.module = Model.get('ir.module.module')(
+            module_id)
+        translation_export.execute('export')
+        if translation_export.form.file:
+            status = save_po(filename, str(translation_export.form.file))
+        else:
+            status = 'empty'
+    except Exception, e:
+        status = 'error: %s' % e
+    return module_name, lang_code, status, time.time() - start
+
+
+def export(settings, modules, languages):
+    '''
+    Exports every (module, language) pair and prints the time spent per
+    language. Over XML-RPC the wizards run on a pool of settings.jobs
+    threads, each one with its own proteus session as proteus keeps its
+    configuration per thread. With trytond they run in this process, where
+    more threads would only contend for the GIL.
+    '''
+    start = time.time()
+    tasks = []
+    for module in modules:
+        path = locale_path(settings.path, module.name)
+        if not path:
+            continue
+        for language in languages:
+            tasks.append((module.id, module.name, language.id, language.code,
+                    os.path.join(path, '%s.po' % language.code)))
+
+    # Per language: [files, written, seconds]
+    timings = dict((x.code, [0, 0, 0.0]) for x in languages)
+    if settings.database:
+        pool = None
+        map_ = itertools.imap
+    else:
+        pool = ThreadPool(max(1, min(settings.jobs or EXPORT_THREADS,
+                    len(tasks))), connect, (settings,))
+        map_ = pool.imap_unordered
+    try:
+        for module, lang, status, seconds in map_(_export, tasks):
+            timing = timings[lang]
+            timing[0] += 1
+            timing[2] += seconds
+            if status == 'written':
+                timing[1] += 1
+                print 'Module \'%s\' (%s) exported successfully.' % (
+                    module, lang)
+            elif status.startswith('error'):
+                print 'Module \'%s\' (%s) %s' % (module, lang, status)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    for lang in sorted(timings):
+        files, written, seconds = timings[lang]
+        print '* %s: %d modules, %d written in %.2fs' % (lang, files,
+            written, seconds)
+    print '* %d exports in %.2fs' % (len(tasks), time.time() - start)
+
+
+if __name__ == "__main__":
+
+    settings = parse_arguments(sys.argv[1:])
+
+    connect(settings)
+
     Module = Model.get('ir.module.module')
     if settings.module == 'all':
         modules = Module.find([('state', '=', 'installed')])
@@ -77,27 +320,17 @@ if __name__ == "__main__":
                 ])
 
     Lang = Model.get('ir.lang')
-    language, = Lang.find([('code', '=', settings.lang)])
+    if settings.lang == 'all':
+        languages = Lang.find([('translatable', '=', True)])
+    else:
+        codes = settings.lang.split(',')
+        languages = Lang.find([('code', 'in', codes)])
+        missing = set(codes) - set(x.code for x in languages)
+        if missing:
+            print 'Languages not found: %s' % ', '.join(sorted(missing))
+            sys.exit(1)
 
-    for module in modules:
-        path = settings.path if settings.path else ''
-        path = os.path.join(path, dest_path % module.name)
-        if not os.path.exists(path):
-            path = settings.path if settings.path else ''
-            path = os.path.join(path, module.name, 'locale')
-            if not os.path.exists(path):
-                print 'Path \'%s\' not found.' % path
-                continue
-        translation_export = Wizard('ir.translation.export')
-        translation_export.form.language = language
-        translation_export.form.module = module
-        translation_export.execute('export')
-        if not translation_export.form.file:
-            continue
-        path = path + '/%s.po' % language.code
-        f = open(path, 'w')
-        try:
-            f.write(str(translation_export.form.file))
-        finally:
-            f.close()
-        print 'Module \'%s\' exported successfully.' % module.name
+    if settings.bulk:
+        bulk_export(settings, modules, [x.code for x in languages])
+    else:
+        export(settings, modules, languages)
@@ -1,23 +1,24 @@
 #!/usr/bin/env python
+import os
 import sys
-from trytond.model.fields.binary import Binary
-from trytond.filestore import filestore
-
-dbname = sys.argv[1]
-config_file = sys.argv[2]
-
-from trytond.config import config as CONFIG
-CONFIG.update_etc(config_file)
-
-from trytond.transaction import Transaction
-from trytond.pool import Pool
+import time
+import hashlib
 import logging
+import multiprocessing
+import sqlite3
+from optparse import OptionParser
+import psycopg2
+try:
+    from psycopg2.extras import execute_values
+except ImportError:
+    execute_values = None
+from common import Settings, database_dsn
 
-Pool.start()
-pool = Pool(dbname)
-pool.init()
-
-context = {}
+# (model, binary field, file_id field) migrated when no model is given
+MIGRATIONS = [
+    ('account.invoice', 'invoice_report_cache', 'report_file_id'),
+    ('ir.attachment', 'data', 'file_id'),
+    ]
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -27,30 +28,297 @@ formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(messag
 ch.setFormatter(formatter)
 logger.addHandler(ch)
 
-with Transaction().start(dbname, 0, context=context):
-    user_obj = pool.get('res.user')
-    user = user_obj.search([('login', '=', 'admin')], limit=1)[0]
-    user_id = user.id
 
-with Transaction().start(dbname, 0, context=context) as transaction:
+def parse_arguments(arguments):
+    usage = 'filestore_download.py [options] <database> <config_file>'
+    parser = OptionParser(usage=usage)
+    parser.add_option('-m', '--model', dest='model',
+        help='Model to migrate, by default invoices and attachments')
+    parser.add_option('-f', '--field', dest='field',
+        help='Binary field of model stored in the database')
+    parser.add_option('-i', '--file-id', dest='file_id',
+        help='Field of model where the filestore id is stored')
+    parser.add_option('-b', '--batch-size', dest='batch_size', type='int',
+        default=500, help='Rows fetched and updated at once')
+    parser.add_option('', '--checkpoint-dir', dest='checkpoint_dir',
+        default='.', help='Directory where the last migrated id is stored')
+    parser.add_option('', '--reset', dest='reset', action='store_true',
+        default=False, help='Ignore existing checkpoints and digest index')
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=1,
+        help='Number of processes hashing and writing files')
+    parser.add_option('', '--verify', dest='verify', action='store_true',
+        default=False, help='Check that every file id exists in the '
+        'filestore after the migration')
+
+    (option, arguments) = parser.parse_args(arguments)
+    if len(arguments) != 2:
+        parser.error('database and config file are required')
+
+    settings = Settings()
+    settings.database, settings.config_file = arguments
+    if option.model:
+        if not option.field or not option.file_id:
+            parser.error('--field and --file-id are required with --model')
+        settings.migrations = [(option.model, option.field, option.file_id)]
+    else:
+        settings.migrations = MIGRATIONS
+    settings.batch_size = option.batch_size
+    settings.checkpoint_dir = option.checkpoint_dir
+    settings.reset = option.reset
+    settings.jobs = option.jobs
+    settings.verify = option.verify
+    return settings
+
+
+def read_checkpoint(filename):
+    if not os.path.exists(filename):
+        return 0
+    with open(filename, 'r') as f:
+        return int(f.read().strip() or 0)
+
+
+def write_checkpoint(filename, id):
+    # Write and rename so a crash never leaves a truncated checkpoint
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        f.write(str(id))
+    os.rename(tmp_filename, filename)
+
+
+def update_rows(cursor, table, field, file_id, values):
+    '''
+    Stores file ids and empties the binary column. values is a list of
+    (file_id, id) tuples.
+    '''
+    if execute_values:
+        execute_values(cursor, 'UPDATE "%(table)s" '
+            'SET "%(file_id)s" = v.file_id, "%(field)s" = NULL '
+            'FROM (VALUES %%s) AS v (file_id, id) '
+            'WHERE "%(table)s".id = v.id' % {
+                'table': table,
+                'field': field,
+                'file_id': file_id,
+                }, values, page_size=len(values))
+    else:
+        cursor.executemany('UPDATE "%s" SET "%s" = %%s, "%s" = NULL '
+            'WHERE id = %%s' % (table, file_id, field), values)
+
+
+class DigestIndex(object):
+    '''
+    Local SQLite index of content digests already stored in the filestore,
+    so content seen in a previous batch or run is neither compared with the
+    filestore nor written again.
+    '''
+    def __init__(self, filename):
+        self.connection = sqlite3.connect(filename)
+        # WAL allows the workers to read while the main process writes
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS digest '
+            '(digest TEXT PRIMARY KEY, file_id TEXT)')
+        self.connection.commit()
+
+    def get(self, digest):
+        row = self.connection.execute('SELECT file_id FROM digest '
+            'WHERE digest = ?', (digest,)).fetchone()
+        return row[0] if row else None
+
+    def add(self, items):
+        self.connection.executemany('INSERT OR REPLACE INTO digest '
+            '(digest, file_id) VALUES (?, ?)', items)
+        self.connection.commit()
+
+
+_worker = {}
+
+
+def _init_worker(index_filename, database):
+    _worker['index'] = DigestIndex(index_filename)
+    _worker['database'] = database
+
+
+def _store(row):
+    '''
+    Stores the content of one row in the filestore unless the digest index
+    knows it and the file is still there, the file may have been collected
+    or lost since it was indexed. Returns (id, file_id, digest, size,
+    duplicate, pid, seconds).
+    '''
+    from trytond.filestore import filestore
+
+    start = time.time()
+    id, value = row
+    digest = '%s-%d' % (hashlib.sha1(value).hexdigest(), len(value))
+    file_id = _worker['index'].get(digest)
+    duplicate = False
+    if file_id is not None:
+        try:
+            duplicate = filestore.size(file_id,
+                prefix=_worker['database']) is not None
+        except (IOError, OSError):
+            pass
+    if not duplicate:
+        file_id = filestore.set(value, prefix=_worker['database'])
+    return (id, file_id, digest, len(value), duplicate, os.getpid(),
+        time.time() - start)
+
+
+def migrate(dsn, database, model, field, file_id, batch_size=500,
+        checkpoint=None, jobs=1, index_filename=None):
+    '''
+    Moves the content of the binary field of model to the filestore.
+
+    Rows are read through a server side cursor in chunks of batch_size.
+    Each chunk is hashed and written by jobs processes, skipping content
+    already in the digest index, and then updated and committed at once on
+    a second connection. The id of the last committed row is stored in the
+    checkpoint file so an interrupted migration continues where it stopped.
+    '''
+    table = model.replace('.', '_')
+    last_id = read_checkpoint(checkpoint) if checkpoint else 0
+    logger.info('Migrating %s.%s to %s.%s from id %s' % (model, field, model,
+            file_id, last_id))
+
+    if not index_filename:
+        index_filename = 'filestore-%s.digest.sqlite' % database
+    index = DigestIndex(index_filename)
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, _init_worker,
+            (index_filename, database))
+        map_ = pool.map
+    else:
+        pool = None
+        _init_worker(index_filename, database)
+        map_ = map
+
+    reader_connection = psycopg2.connect(dsn)
+    writer_connection = psycopg2.connect(dsn)
+    # Per worker pid: [rows, bytes, seconds]
+    workers = {}
+    stats = {
+        'rows': 0,
+        'size': 0,
+        'duplicates': 0,
+        }
+    start = time.time()
+
+    def flush(batch):
+        digests = []
+        values = []
+        for (id, file_id_, digest, size, duplicate, pid,
+                seconds) in map_(_store, batch):
+            values.append((file_id_, id))
+            if duplicate:
+                stats['duplicates'] += 1
+            else:
+                digests.append((digest, file_id_))
+            worker = workers.setdefault(pid, [0, 0, 0.0])
+            worker[0] += 1
+            worker[1] += size
+            worker[2] += seconds
+            stats['size'] += size
+        update_rows(writer, table, field, file_id, values)
+        writer_connection.commit()
+        index.add(digests)
+        if checkpoint:
+            write_checkpoint(checkpoint, batch[-1][0])
+        stats['rows'] += len(batch)
+        elapsed = time.time() - start
+        logger.info('%d rows, %.1f MB, %d duplicates, %.1f rows/s' % (
+                stats['rows'], stats['size'] / 1048576.0,
+                stats['duplicates'],
+                stats['rows'] / elapsed if elapsed else 0))
+
+    try:
+        reader = reader_connection.cursor('filestore_%s' % table)
+        reader.itersize = batch_size
+        reader.execute('SELECT id, "%s" FROM "%s" '
+            'WHERE "%s" IS NOT NULL AND id > %%s ORDER BY id'
+            % (field, table, field), (last_id,))
+        writer = writer_connection.cursor()
+
+        batch = []
+        for id, value in reader:
+            batch.append((id, bytes(value)))
+            if len(batch) >= batch_size:
+                flush(batch)
+                batch = []
+        if batch:
+            flush(batch)
+        reader.close()
+    finally:
+        reader_connection.close()
+        writer_connection.close()
+        if pool:
+            pool.close()
+            pool.join()
+
+    logger.info('Migrated %d rows (%.1f MB, %d duplicates) of %s in %.1fs'
+        % (stats['rows'], stats['size'] / 1048576.0, stats['duplicates'],
+            model, time.time() - start))
+    for pid, (rows, size, seconds) in sorted(workers.items()):
+        logger.info('  worker %d: %d rows, %.1f MB/s, %.1f rows/s' % (pid,
+                rows, size / 1048576.0 / seconds if seconds else 0,
+                rows / seconds if seconds else 0))
+    return stats['rows']
+
+
+def verify(dsn, database, model, file_id, batch_size=500):
+    '''
+    Streams all file ids of model and checks that each one exists in the
+    filestore. Returns the number of missing files.
+    '''
+    from trytond.filestore import filestore
+
+    table = model.replace('.', '_')
+    connection = psycopg2.connect(dsn)
+    rows = missing = 0
+    try:
+        cursor = connection.cursor('filestore_verify_%s' % table)
+        cursor.itersize = batch_size
+        cursor.execute('SELECT id, "%s" FROM "%s" WHERE "%s" IS NOT NULL '
+            'ORDER BY id' % (file_id, table, file_id))
+        for id, file_id_ in cursor:
+            rows += 1
+            try:
+                size = filestore.size(file_id_, prefix=database)
+            except (IOError, OSError):
+                size = None
+            if size is None:
+                missing += 1
+                logger.error('%s %d: file %s not found' % (model, id,
+                        file_id_))
+        cursor.close()
+    finally:
+        connection.close()
+    logger.info('Verified %d files of %s, %d missing' % (rows, model,
+            missing))
+    return missing
 
-    Invoice = pool.get('account.invoice')
-    cursor = Transaction().cursor
 
-    for invoice in Invoice.search([('invoice_report_cache','!=', None)]):
-        value = invoice.invoice_report_cache
-        invoice.invoice_report_cache = None
-        basename = filestore.set(value)
-        cursor.execute("UPDATE account_invoice set report_file_id='%s', invoice_report_cache=null Where id = %s" % (basename, invoice.id) )
-        cursor.commit()
+if __name__ == '__main__':
+    settings = parse_arguments(sys.argv[1:])
 
-with Transaction().start(dbname, 0, context=context) as transaction:
+    from trytond.config import config as CONFIG
+    CONFIG.update_etc(settings.config_file)
+    dsn = database_dsn(CONFIG.get('database', 'uri'), settings.database)
 
-    Attachment = pool.get('ir.attachment')
-    cursor = Transaction().cursor
+    index_filename = os.path.join(settings.checkpoint_dir,
+        'filestore-%s.digest.sqlite' % settings.database)
+    if settings.reset:
+        for filename in (index_filename, index_filename + '-wal',
+                index_filename + '-shm'):
+            if os.path.exists(filename):
+                os.remove(filename)
 
-    for attach in Attachment.search([('file_id', "=", None)]):
-        value = attach.data
-        basename = filestore.set(value)
-        cursor.execute("UPDATE ir_attachment set file_id='%s', data=null Where id = %s" % (basename, invoice.id) )
-        cursor.commit()
+    for model, field, file_id in settings.migrations:
+        checkpoint = os.path.join(settings.checkpoint_dir,
+            'filestore-%s-%s-%s.checkpoint' % (settings.database, model,
+                field))
+        if settings.reset and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        migrate(dsn, settings.database, model, field, file_id,
+            settings.batch_size, checkpoint, settings.jobs, index_filename)
+        if settings.verify:
+            verify(dsn, settings.database, model, file_id,
+                settings.batch_size)
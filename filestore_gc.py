@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+import os
+import re
+import sys
+import time
+import shutil
+import binascii
+import tempfile
+import logging
+import multiprocessing
+from optparse import OptionParser
+import psycopg2
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+from common import Settings, database_dsn
+
+HEX_ID = re.compile('^[0-9a-f]{32}$')
+# Orphans checked again against the database at once before being moved
+RECHECK_SIZE = 1000
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler(sys.stderr)
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+# Referenced file ids grouped by filestore directory (first two characters).
+# Ids that are md5 digests are packed as 16 bytes in a bytearray, any other
+# id (like collision suffixed ones) is kept in a set. Filled before the
+# worker pool is created so workers share it through fork.
+_references = {}
+_extra_references = {}
+
+
+def parse_arguments(arguments):
+    usage = 'filestore_gc.py [options] <database> <config_file>'
+    parser = OptionParser(usage=usage)
+    parser.add_option('-c', '--column', dest='columns', action='append',
+        default=[], help='Additional table.column holding file ids')
+    parser.add_option('-q', '--quarantine', dest='quarantine',
+        help='Move orphan files to this directory')
+    parser.add_option('-n', '--dry-run', dest='dry_run', action='store_true',
+        default=False, help='Only report what would be moved')
+    parser.add_option('-o', '--output', dest='output',
+        help='File where orphan paths are written, stdout by default')
+    parser.add_option('-j', '--jobs', dest='jobs', type='int',
+        default=multiprocessing.cpu_count(),
+        help='Number of processes walking the filestore')
+    parser.add_option('', '--min-age', dest='min_age', type='float',
+        default=24, help='Ignore files modified in the last hours, they may '
+        'belong to uncommitted transactions')
+
+    (option, arguments) = parser.parse_args(arguments)
+    if len(arguments) != 2:
+        parser.error('database and config file are required')
+
+    settings = Settings()
+    settings.database, settings.config_file = arguments
+    settings.columns = []
+    for column in option.columns:
+        if not '.' in column:
+            parser.error('Columns must be given as table.column')
+        settings.columns.append(tuple(column.split('.', 1)))
+    settings.quarantine = option.quarantine
+    settings.dry_run = option.dry_run
+    settings.output = option.output
+    settings.jobs = option.jobs
+    settings.min_age = option.min_age
+    return settings
+
+
+def discover_columns(cursor):
+    '''
+    Returns the (table, column) pairs that may hold filestore ids: text
+    columns named file_id or ending with _file_id.
+    '''
+    cursor.execute('SELECT table_name, column_name '
+        'FROM information_schema.columns '
+        'WHERE table_schema = current_schema() '
+            'AND data_type IN (\'character varying\', \'text\') '
+            'AND (column_name = \'file_id\' '
+                'OR column_name LIKE \'%\\_file\\_id\') '
+        'ORDER BY table_name, column_name')
+    return cursor.fetchall()
+
+
+def model_columns(database):
+    '''
+    Returns the (table, column) pairs where Binary fields of the models of
+    database store their filestore id, read from the field definitions as
+    file_id may name any column.
+    '''
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+    from trytond.model import ModelSQL, fields
+
+    pool = Pool(database)
+    pool.init()
+    columns = set()
+    with Transaction().start(database, 0):
+        for _, Model in pool.iterobject():
+            if (not issubclass(Model, ModelSQL)
+                    or Model.table_query() is not None):
+                continue
+            for field in Model._fields.itervalues():
+                if (isinstance(field, fields.Binary)
+                        and getattr(field, 'file_id', None)):
+                    columns.add((Model._table, field.file_id))
+    return sorted(columns)
+
+
+def load_references(dsn, columns, itersize=100000):
+    '''
+    Streams the distinct file ids of all columns into _references and
+    _extra_references. Returns the number of ids loaded.
+    '''
+    query = ' UNION '.join('SELECT "%s" AS id FROM "%s" WHERE "%s" IS NOT NULL'
+        % (column, table, column) for table, column in columns)
+    connection = psycopg2.connect(dsn)
+    count = 0
+    try:
+        cursor = connection.cursor('filestore_gc')
+        cursor.itersize = itersize
+        cursor.execute(query)
+        for id, in cursor:
+            if HEX_ID.match(id):
+                _references.setdefault(id[0:2], bytearray()).extend(
+                    binascii.unhexlify(id))
+            else:
+                _extra_references.setdefault(id[0:2], set()).add(id)
+            count += 1
+        cursor.close()
+    finally:
+        connection.close()
+    return count
+
+
+def referenced(cursor, columns, ids):
+    '''
+    Returns the ids, among ids, that are referenced by any of columns.
+    '''
+    cursor.execute(' UNION '.join('SELECT "%s" FROM "%s" '
+            'WHERE "%s" = ANY(%%(ids)s)' % (column, table, column)
+            for table, column in columns), {'ids': ids})
+    return set(id for id, in cursor.fetchall())
+
+
+def _quarantine(root, quarantine, cursor, columns, candidates):
+    '''
+    Moves the candidates (path, name, size) to quarantine, except those a
+    row committed since the references were loaded points to. Returns the
+    moved ones.
+    '''
+    found = referenced(cursor, columns, [x[1] for x in candidates])
+    if found:
+        logger.info('%d files referenced since the scan started, kept'
+            % len(found))
+    moved = []
+    for path, name, file_size in candidates:
+        if name in found:
+            continue
+        destination = os.path.join(quarantine, os.path.relpath(path, root))
+        if not os.path.isdir(os.path.dirname(destination)):
+            try:
+                os.makedirs(os.path.dirname(destination))
+            except OSError:
+                # Created by another worker
+                pass
+        shutil.move(path, destination)
+        moved.append((path, name, file_size))
+    return moved
+
+
+def _iter_files(path):
+    '''
+    Yields (path, name, size, mtime) of all files under path without
+    building lists of the whole tree.
+    '''
+    if scandir:
+        for entry in scandir(path):
+            if entry.is_dir(follow_symlinks=False):
+                for item in _iter_files(entry.path):
+                    yield item
+            elif entry.is_file(follow_symlinks=False):
+                stat = entry.stat(follow_symlinks=False)
+                yield entry.path, entry.name, stat.st_size, stat.st_mtime
+    else:
+        for name in os.listdir(path):
+            filename = os.path.join(path, name)
+            if os.path.isdir(filename) and not os.path.islink(filename):
+                for item in _iter_files(filename):
+                    yield item
+            elif os.path.isfile(filename):
+                stat = os.lstat(filename)
+                yield filename, name, stat.st_size, stat.st_mtime
+
+
+def _scan_directory(args):
+    '''
+    Worker: scans one top level filestore directory and writes the orphan
+    paths to a temporary file. Returns (files, bytes, orphans, orphan
+    bytes, output filename).
+    '''
+    root, directory, quarantine, dry_run, min_mtime, dsn, columns = args
+    packed = _references.get(directory, '')
+    references = set(str(packed[i:i + 16]) for i in xrange(0, len(packed),
+            16))
+    extra = _extra_references.get(directory, set())
+
+    files = size = orphans = orphan_size = 0
+    # Rows committed during the scan may reference old files, as when
+    # filestore.set finds the content already stored, so orphans are
+    # checked again before being moved
+    move = quarantine and not dry_run
+    connection = psycopg2.connect(dsn) if move else None
+    candidates = []
+    fd, output = tempfile.mkstemp(prefix='filestore_gc.')
+
+    def flush(f):
+        if move and candidates:
+            orphans_ = _quarantine(root, quarantine, connection.cursor(),
+                columns, candidates)
+            connection.rollback()
+        else:
+            orphans_ = candidates
+        for path, _, file_size in orphans_:
+            f.write(path + '\n')
+        del candidates[:]
+        return len(orphans_), sum(x[2] for x in orphans_)
+
+    with os.fdopen(fd, 'w') as f:
+        for path, name, file_size, mtime in _iter_files(
+                os.path.join(root, directory)):
+            files += 1
+            size += file_size
+            if HEX_ID.match(name):
+                if binascii.unhexlify(name) in references:
+                    continue
+            elif name in extra:
+                continue
+            if mtime > min_mtime:
+                continue
+            candidates.append((path, name, file_size))
+            if len(candidates) >= RECHECK_SIZE:
+                count, count_size = flush(f)
+                orphans += count
+                orphan_size += count_size
+        count, count_size = flush(f)
+        orphans += count
+        orphan_size += count_size
+    if connection:
+        connection.close()
+    return files, size, orphans, orphan_size, output
+
+
+def collect(root, dsn, columns, quarantine=None, dry_run=False, jobs=1,
+        min_age=24, output=sys.stdout):
+    '''
+    Walks the filestore directory of the database in parallel, one task per
+    top level directory, and writes orphan paths to output. If quarantine
+    is set orphans are moved there unless dry_run is set, after checking
+    again in columns that no row references them now.
+    '''
+    directories = sorted(x for x in os.listdir(root)
+        if len(x) == 2 and os.path.isdir(os.path.join(root, x)))
+    min_mtime = time.time() - min_age * 3600
+    pool = multiprocessing.Pool(jobs)
+    totals = [0, 0, 0, 0]
+    try:
+        for result in pool.imap_unordered(_scan_directory,
+                [(root, x, quarantine, dry_run, min_mtime, dsn, columns)
+                    for x in directories]):
+            with open(result[-1], 'r') as f:
+                shutil.copyfileobj(f, output)
+            os.remove(result[-1])
+            for i, value in enumerate(result[:-1]):
+                totals[i] += value
+    finally:
+        pool.close()
+        pool.join()
+    return totals
+
+
+if __name__ == '__main__':
+    settings = parse_arguments(sys.argv[1:])
+
+    from trytond.config import config as CONFIG
+    CONFIG.update_etc(settings.config_file)
+    dsn = database_dsn(CONFIG.get('database', 'uri'), settings.database)
+    root = os.path.join(os.path.normpath(CONFIG.get('database', 'path')),
+        settings.database)
+
+    start = time.time()
+    connection = psycopg2.connect(dsn)
+    try:
+        columns = discover_columns(connection.cursor())
+    finally:
+        connection.close()
+    try:
+        columns += model_columns(settings.database)
+    except Exception:
+        logger.exception('Could not read Binary fields from the models')
+        # Columns not matching the file_id names would be missed and
+        # their files moved as orphans
+        if (settings.quarantine and not settings.dry_run
+                and not settings.columns):
+            logger.error('Refusing to quarantine: give the file id columns '
+                'with -c after reviewing a --dry-run report')
+            sys.exit(1)
+    columns = sorted(set(columns + settings.columns))
+    logger.info('Columns: %s' % ', '.join('%s.%s' % x for x in columns))
+    count = load_references(dsn, columns)
+    logger.info('%d referenced files loaded in %.1fs' % (count,
+            time.time() - start))
+
+    output = open(settings.output, 'w') if settings.output else sys.stdout
+    try:
+        files, size, orphans, orphan_size = collect(root, dsn, columns,
+            settings.quarantine, settings.dry_run, settings.jobs,
+            settings.min_age, output)
+    finally:
+        if settings.output:
+            output.close()
+
+    if settings.quarantine:
+        action = 'would be moved' if settings.dry_run else 'moved'
+        action += ' to %s' % settings.quarantine
+    else:
+        action = 'found'
+    logger.info('%d files (%.1f MB) scanned, %d orphans (%.1f MB) %s in '
+        '%.1fs' % (files, size / 1048576.0, orphans, orphan_size / 1048576.0,
+            action, time.time() - start))
@@ -0,0 +1,426 @@
+#!/usr/bin/env python
+'''
+Packs cold filestore files into large append-only pack files.
+
+Each pack is a pair of files in the "packs" directory of the database
+filestore: <name>.pack with the concatenated contents and <name>.idx with
+one fixed size record (key, offset, length) per file sorted by key. The
+index is memory-mapped so a lookup is a binary search plus one pread.
+
+To let trytond read packed files add the utils directory to PYTHONPATH and
+set in its configuration file::
+
+    [database]
+    class = filestore_pack.PackFileStore
+'''
+import os
+import re
+import sys
+import time
+import mmap
+import random
+import struct
+import hashlib
+import binascii
+import logging
+import threading
+from optparse import OptionParser
+from trytond.config import config as CONFIG
+from trytond.filestore import FileStore
+from common import Settings, database_dsn
+
+HEX_ID = re.compile('^[0-9a-f]{32}$')
+RECORD = struct.Struct('>16sQQ')
+PACKS_DIRECTORY = 'packs'
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler(sys.stdout)
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+
+def _key(file_id):
+    '''
+    Returns the 16 bytes index key of file_id: the digest itself for plain
+    md5 ids and the md5 of the id for any other one.
+    '''
+    if HEX_ID.match(file_id):
+        return binascii.unhexlify(file_id)
+    return hashlib.md5(file_id).digest()
+
+
+def _pread(fd, length, offset, lock):
+    if hasattr(os, 'pread'):
+        return os.pread(fd, length, offset)
+    # Python 2 has no os.pread, the file position is shared by the threads
+    # reading the pack
+    chunks = []
+    with lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        while length:
+            chunk = os.read(fd, length)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            length -= len(chunk)
+    return ''.join(chunks)
+
+
+class Pack(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.fd = os.open(filename + '.pack', os.O_RDONLY)
+        with open(filename + '.idx', 'rb') as f:
+            self.index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.count = len(self.index) // RECORD.size
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def record(self, position):
+        return RECORD.unpack_from(self.index, position * RECORD.size)
+
+    def find(self, key):
+        '''
+        Returns (offset, length) of key or None if it is not in the pack.
+        '''
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            start = middle * RECORD.size
+            current = self.index[start:start + 16]
+            if current < key:
+                low = middle + 1
+            elif current > key:
+                high = middle
+            else:
+                return self.record(middle)[1:]
+        return None
+
+    def get(self, key):
+        found = self.find(key)
+        if found is None:
+            return None
+        offset, length = found
+        return self.read(offset, length)
+
+    def read(self, offset, length):
+        return _pread(self.fd, length, offset, self.lock)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.index.close()
+        os.close(self.fd)
+
+    def __del__(self):
+        self.close()
+
+
+class PackReader(object):
+    '''
+    Reads files from all packs of a directory, newest pack first.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        self.packs = []
+        self.mtime = None
+        self.reload()
+
+    def reload(self):
+        '''
+        Replaces the list of packs by a new one, keeping the packs already
+        open. Packs are never closed here as other threads may be reading
+        them, a pack is closed when no thread references it any more.
+        '''
+        try:
+            mtime = os.stat(self.directory).st_mtime
+        except OSError:
+            return
+        if mtime == self.mtime:
+            return
+        current = dict((x.filename, x) for x in self.packs)
+        names = sorted((x[:-4] for x in os.listdir(self.directory)
+                if x.endswith('.idx')), reverse=True)
+        packs = []
+        for name in names:
+            filename = os.path.join(self.directory, name)
+            packs.append(current.get(filename) or Pack(filename))
+        self.packs = packs
+        self.mtime = mtime
+
+    def find(self, file_id):
+        key = _key(file_id)
+        # Readers keep the list they started with if reload() replaces it
+        for pack in self.packs:
+            found = pack.find(key)
+            if found is not None:
+                return pack, found
+        return None, None
+
+    def get(self, file_id):
+        pack, found = self.find(file_id)
+        if pack is None:
+            return None
+        offset, length = found
+        return pack.read(offset, length)
+
+    def size(self, file_id):
+        pack, found = self.find(file_id)
+        if pack is None:
+            return None
+        return found[1]
+
+
+class PackFileStore(FileStore):
+    '''
+    trytond FileStore that falls back to the packs when a file is not found
+    in the filestore tree.
+    '''
+    _readers = {}
+
+    def _pack_reader(self, prefix):
+        reader = self._readers.get(prefix)
+        if reader is None:
+            path = os.path.normpath(CONFIG.get('database', 'path'))
+            reader = PackReader(os.path.join(path, prefix, PACKS_DIRECTORY))
+            self._readers[prefix] = reader
+        else:
+            reader.reload()
+        return reader
+
+    def get(self, id, prefix=''):
+        try:
+            return super(PackFileStore, self).get(id, prefix)
+        except (IOError, OSError):
+            data = self._pack_reader(prefix).get(id)
+            if data is None:
+                raise
+            return data
+
+    def size(self, id, prefix=''):
+        try:
+            return super(PackFileStore, self).size(id, prefix)
+        except (IOError, OSError):
+            size = self._pack_reader(prefix).size(id)
+            if size is None:
+                raise
+            return size
+
+
+class PackWriter(object):
+    '''
+    Appends files to a new pack. The index is written and both files are
+    synced on close, only then are the loose files removed.
+    '''
+    def __init__(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        name = 'pack-%s' % time.strftime('%Y%m%d%H%M%S')
+        suffix = 0
+        while os.path.exists(os.path.join(directory, name + '.idx')):
+            suffix += 1
+            name = 'pack-%s-%d' % (time.strftime('%Y%m%d%H%M%S'), suffix)
+        self.filename = os.path.join(directory, name)
+        self.file = open(self.filename + '.pack.tmp', 'wb')
+        self.records = {}
+        self.paths = []
+        self.size = 0
+
+    def add(self, file_id, path):
+        key = _key(file_id)
+        if key in self.records:
+            return
+        with open(path, 'rb') as f:
+            data = f.read()
+        self.file.write(data)
+        self.records[key] = (self.size, len(data))
+        self.paths.append(path)
+        self.size += len(data)
+
+    def close(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        if not self.records:
+            os.remove(self.filename + '.pack.tmp')
+            return 0
+        with open(self.filename + '.idx.tmp', 'wb') as f:
+            for key in sorted(self.records):
+                offset, length = self.records[key]
+                f.write(RECORD.pack(key, offset, length))
+            f.flush()
+            os.fsync(f.fileno())
+        # The index is renamed last as readers only look for .idx files
+        os.rename(self.filename + '.pack.tmp', self.filename + '.pack')
+        os.rename(self.filename + '.idx.tmp', self.filename + '.idx')
+        for path in self.paths:
+            os.remove(path)
+        return len(self.paths)
+
+
+def pack(dsn, root, model, file_id, months, max_size, itersize=10000):
+    '''
+    Moves the files of model that no row, of model or of any other file id
+    column, has written in the last months to packs of at most max_size
+    bytes. Returns the number of packed files.
+    '''
+    import psycopg2
+    from filestore_gc import discover_columns
+
+    table = model.replace('.', '_')
+    directory = os.path.join(root, PACKS_DIRECTORY)
+    connection = psycopg2.connect(dsn)
+    writer = None
+    count = 0
+    try:
+        cursor = connection.cursor()
+        # Content is deduplicated, so the same file id may be used by recent
+        # rows of model or of other tables
+        others = [x for x in discover_columns(cursor) if x != (table, file_id)]
+        cursor.execute('SELECT DISTINCT table_name '
+            'FROM information_schema.columns '
+            'WHERE table_schema = current_schema() '
+                'AND column_name = \'create_date\'')
+        dated = set(x for x, in cursor.fetchall())
+        recent = '< NOW() - %(months)s * INTERVAL \'1 month\''
+        query = ('SELECT t."%(file_id)s" FROM "%(table)s" t '
+            'WHERE t."%(file_id)s" IS NOT NULL '
+            'GROUP BY t."%(file_id)s" '
+            'HAVING MAX(COALESCE(t.write_date, t.create_date)) ' % {
+                'table': table,
+                'file_id': file_id,
+                }) + recent
+        for other_table, column in others:
+            query += (' AND NOT EXISTS (SELECT 1 FROM "%s" o '
+                'WHERE o."%s" = t."%s"' % (other_table, column, file_id))
+            if other_table in dated:
+                query += (' AND NOT COALESCE(o.write_date, o.create_date) '
+                    + recent)
+            query += ')'
+        cursor.close()
+
+        cursor = connection.cursor('filestore_pack')
+        cursor.itersize = itersize
+        cursor.execute(query, {'months': months})
+        for id, in cursor:
+            path = os.path.join(root, id[0:2], id[2:4], id)
+            if not os.path.isfile(path):
+                # Already packed or missing
+                continue
+            if writer is None:
+                writer = PackWriter(directory)
+            writer.add(id, path)
+            if writer.size >= max_size:
+                count += writer.close()
+                logger.info('%s written, %d files packed' % (
+                        writer.filename, count))
+                writer = None
+        cursor.close()
+    finally:
+        connection.close()
+        if writer is not None:
+            count += writer.close()
+            logger.info('%s written, %d files packed' % (writer.filename,
+                    count))
+    return count
+
+
+def _percentiles(timings):
+    timings = sorted(timings)
+    if not timings:
+        return 0, 0, 0
+    return (sum(timings) / len(timings), timings[len(timings) // 2],
+        timings[min(len(timings) - 1, int(len(timings) * 0.99))])
+
+
+def benchmark(root, samples):
+    '''
+    Compares random read latency of packed files against loose files.
+    '''
+    reader = PackReader(os.path.join(root, PACKS_DIRECTORY))
+    pack_timings = []
+    if reader.packs:
+        for _ in xrange(samples):
+            pack = random.choice(reader.packs)
+            key = pack.record(random.randrange(pack.count))[0]
+            start = time.time()
+            pack.get(key)
+            pack_timings.append(time.time() - start)
+
+    # Reservoir sample of loose files so the tree is not kept in memory
+    paths = []
+    seen = 0
+    for dirpath, _, filenames in os.walk(root):
+        if PACKS_DIRECTORY in os.path.relpath(dirpath, root).split(os.sep):
+            continue
+        for filename in filenames:
+            seen += 1
+            if len(paths) < samples:
+                paths.append(os.path.join(dirpath, filename))
+            else:
+                position = random.randrange(seen)
+                if position < samples:
+                    paths[position] = os.path.join(dirpath, filename)
+    random.shuffle(paths)
+    loose_timings = []
+    for path in paths:
+        start = time.time()
+        with open(path, 'rb') as f:
+            f.read()
+        loose_timings.append(time.time() - start)
+
+    for name, timings in (('packs', pack_timings), ('loose', loose_timings)):
+        mean, median, p99 = _percentiles(timings)
+        print '%-6s %6d reads  mean %8.1fus  p50 %8.1fus  p99 %8.1fus' % (
+            name, len(timings), mean * 1e6, median * 1e6, p99 * 1e6)
+
+
+def parse_arguments(arguments):
+    usage = 'filestore_pack.py [options] <database> <config_file>'
+    parser = OptionParser(usage=usage)
+    parser.add_option('-m', '--model', dest='model', default='ir.attachment',
+        help='Model whose files are packed')
+    parser.add_option('-i', '--file-id', dest='file_id', default='file_id',
+        help='Field of model where the filestore id is stored')
+    parser.add_option('', '--months', dest='months', type='int', default=12,
+        help='Pack files of records not written in this number of months')
+    parser.add_option('', '--max-size', dest='max_size', type='int',
+        default=1024, help='Maximum size of each pack in MB')
+    parser.add_option('', '--benchmark', dest='benchmark', type='int',
+        help='Do not pack, compare the latency of this number of random '
+        'reads from packs and loose files')
+
+    (option, arguments) = parser.parse_args(arguments)
+    if len(arguments) != 2:
+        parser.error('database and config file are required')
+
+    settings = Settings()
+    settings.database, settings.config_file = arguments
+    settings.model = option.model
+    settings.file_id = option.file_id
+    settings.months = option.months
+    settings.max_size = option.max_size * 1024 * 1024
+    settings.benchmark = option.benchmark
+    return settings
+
+
+if __name__ == '__main__':
+    settings = parse_arguments(sys.argv[1:])
+
+    CONFIG.update_etc(settings.config_file)
+    root = os.path.join(os.path.normpath(CONFIG.get('database', 'path')),
+        settings.database)
+
+    if settings.benchmark:
+        benchmark(root, settings.benchmark)
+        sys.exit(0)
+
+    start = time.time()
+    dsn = database_dsn(CONFIG.get('database', 'uri'), settings.database)
+    count = pack(dsn, root, settings.model, settings.file_id,
+        settings.months, settings.max_size)
+    logger.info('%d files packed in %.1fs' % (count, time.time() - start))
@@ -1,8 +1,21 @@
 #!/usr/bin/env python
+import sys
+import time
+import multiprocessing
+from cStringIO import StringIO
+from optparse import OptionParser
 import psycopg2
+from common import Settings
 
 tables=[('timesheet_work','parent')]
 
+MODES = ('recursive', 'bulk', 'incremental')
+
+MARK_TABLE = 'parent_store_mark'
+# Seconds the stored mark is moved back to cover the difference between the
+# timestamps of the transactions and the start time PostgreSQL reports
+MARK_MARGIN = 60
+
 def _parent_store_compute(cr, table, field):
         def browse_rec(root, pos=0):
             where = field + '=' + str(root)
@@ -29,29 +42,445 @@ def _parent_store_compute(cr, table, field):
         return True
 
 
-def calc_parent_leftright(targetCR):
+def _compute_left_right(roots, childs):
+    '''
+    Iterative version of browse_rec: yields (id, left, right) for every node
+    reachable from roots, numbering them exactly as _parent_store_compute
+    does but without recursion, so tree depth is not limited by the stack.
+    '''
+    pos = 0
+    for root in roots:
+        lefts = {root: pos}
+        pos += 1
+        stack = [(root, iter(childs.get(root, ())))]
+        while stack:
+            node, children = stack[-1]
+            child = next(children, None)
+            if child is None:
+                stack.pop()
+                yield node, lefts.pop(node), pos
+                pos += 1
+                continue
+            lefts[child] = pos
+            pos += 1
+            stack.append((child, iter(childs.get(child, ()))))
+
+
+def _parent_store_compute_bulk(cr, table, field, itersize=10000):
+    '''
+    Rebuild "left" and "right" of table with three statements: one streamed
+    SELECT of all (id, parent) pairs, one COPY into a temporary table and one
+    UPDATE ... FROM that only touches rows whose values changed.
+    '''
+    timings = []
+    start = time.time()
+
+    # Named cursors are server side cursors, rows are fetched in chunks of
+    # itersize instead of loading the whole table at once
+    reader = cr.connection.cursor('parent_store_%s' % table)
+    reader.itersize = itersize
+    reader.execute('SELECT id, "%s" FROM "%s" ORDER BY id' % (field, table))
+    roots = []
+    childs = {}
+    for id, parent in reader:
+        if parent is None:
+            roots.append(id)
+        else:
+            childs.setdefault(parent, []).append(id)
+    reader.close()
+    timings.append(('read', time.time() - start))
+
+    start = time.time()
+    data = StringIO()
+    count = 0
+    for id, left, right in _compute_left_right(roots, childs):
+        data.write('%d\t%d\t%d\n' % (id, left, right))
+        count += 1
+    data.seek(0)
+    timings.append(('compute', time.time() - start))
+
+    start = time.time()
+    tmp_table = 'parent_store_%s' % table
+    cr.execute('CREATE TEMPORARY TABLE "%s" (id INTEGER, "left" INTEGER, '
+        '"right" INTEGER)' % tmp_table)
+    cr.copy_from(data, tmp_table, columns=('id', 'left', 'right'))
+    cr.execute('UPDATE "%(table)s" SET "left" = n."left", '
+            '"right" = n."right" '
+        'FROM "%(tmp)s" n '
+        'WHERE "%(table)s".id = n.id '
+            'AND ("%(table)s"."left" IS DISTINCT FROM n."left" '
+                'OR "%(table)s"."right" IS DISTINCT FROM n."right")' % {
+            'table': table,
+            'tmp': tmp_table,
+            })
+    updated = cr.rowcount
+    cr.execute('DROP TABLE "%s"' % tmp_table)
+    timings.append(('write', time.time() - start))
+
+    print "  * %d nodes, %d rows updated" % (count, updated)
+    print "  * " + ', '.join('%s: %.2fs' % x for x in timings)
+    return True
+
+
+def _get_mark(cr, table, field):
+    cr.execute('CREATE TABLE IF NOT EXISTS "%s" ("table" VARCHAR, '
+        'field VARCHAR, mark TIMESTAMP, PRIMARY KEY ("table", field))'
+        % MARK_TABLE)
+    cr.execute('SELECT mark FROM "%s" WHERE "table" = %%s AND field = %%s'
+        % MARK_TABLE, (table, field))
+    row = cr.fetchone()
+    return row[0] if row else None
+
+
+def _set_mark(cr, table, field, mark):
+    cr.execute('UPDATE "%s" SET mark = %%s WHERE "table" = %%s AND field = %%s'
+        % MARK_TABLE, (mark, table, field))
+    if not cr.rowcount:
+        cr.execute('INSERT INTO "%s" ("table", field, mark) '
+            'VALUES (%%s, %%s, %%s)' % MARK_TABLE, (table, field, mark))
+
+
+def _update_tree(cr, table, field, id):
+    '''
+    Move the subtree of id to the end of its parent using range UPDATEs, the
+    same gap arithmetic used by ModelSQL._update_tree in trytond. The space
+    left at the old position is not reclaimed, which nested-set queries
+    do not need.
+
+    Returns False if the numbering of the parent is not usable.
+    '''
+    cr.execute('SELECT "left", "right", "%s" FROM "%s" WHERE id = %%s'
+        % (field, table), (id,))
+    old_left, old_right, parent = cr.fetchone()
+    if old_left is None or old_right is None or old_left >= old_right:
+        # New node, append it as a leaf after the last root
+        cr.execute('SELECT MAX("right") FROM "%s"' % table)
+        old_left = (cr.fetchone()[0] or 0) + 1
+        old_right = old_left + 1
+        cr.execute('UPDATE "%s" SET "left" = %%s, "right" = %%s '
+            'WHERE id = %%s' % table, (old_left, old_right, id))
+    size = old_right - old_left + 1
+
+    if parent is not None:
+        cr.execute('SELECT "right" FROM "%s" WHERE id = %%s' % table,
+            (parent,))
+        row = cr.fetchone()
+        if not row or row[0] is None:
+            return False
+        parent_right = row[0]
+    else:
+        cr.execute('SELECT MAX("right") FROM "%s"' % table)
+        parent_right = cr.fetchone()[0] + 1
+
+    cr.execute('UPDATE "%s" SET "left" = "left" + %%s WHERE "left" >= %%s'
+        % table, (size, parent_right))
+    cr.execute('UPDATE "%s" SET "right" = "right" + %%s WHERE "right" >= %%s'
+        % table, (size, parent_right))
+    if old_left < parent_right:
+        delta = parent_right - old_left
+        left_cond = old_left
+        right_cond = old_right
+    else:
+        delta = parent_right - old_left - size
+        left_cond = old_left + size
+        right_cond = old_right + size
+    cr.execute('UPDATE "%s" SET "left" = "left" + %%s, "right" = "right" + %%s '
+        'WHERE "left" >= %%s AND "right" <= %%s' % table,
+        (delta, delta, left_cond, right_cond))
+    return True
+
+
+def _parent_store_compute_incremental(cr, table, field, max_changes=1000):
+    '''
+    Renumber only the subtrees whose parent changed since the last run.
+
+    Rows written after the high-water mark stored in MARK_TABLE are checked
+    and those not placed directly under their parent are moved with
+    _update_tree. Falls back to _parent_store_compute_bulk on the first run,
+    when there are more than max_changes misplaced nodes or when the
+    existing numbering can not be used.
+    '''
+    start = time.time()
+    # Block concurrent writers while the tree is renumbered
+    cr.execute('LOCK TABLE "%s" IN SHARE ROW EXCLUSIVE MODE' % table)
+    mark = _get_mark(cr, table, field)
+    # write_date is the start time of the writing transaction, so one
+    # started before the lock may still commit rows older than the newest
+    # one. The mark is not moved past the oldest open transaction of the
+    # database, less MARK_MARGIN, so those rows are checked on the next run.
+    cr.execute('SELECT LEAST(MAX(COALESCE(write_date, create_date)), '
+            "(SELECT MIN(xact_start) AT TIME ZONE 'UTC' "
+                'FROM pg_stat_activity '
+                'WHERE datname = current_database() '
+                    'AND pid != pg_backend_pid())) '
+            "- INTERVAL '%d seconds' "
+        'FROM "%s"' % (MARK_MARGIN, table))
+    new_mark = cr.fetchone()[0]
+
+    if mark is None:
+        print "  * No high-water mark found, running full rebuild"
+        _parent_store_compute_bulk(cr, table, field)
+        if new_mark:
+            _set_mark(cr, table, field, new_mark)
+        return True
+
+    # A node is misplaced if it has no valid numbering, it is not inside its
+    # parent or there is another node between them (or above it for roots)
+    cr.execute('SELECT c.id, c."%(field)s" FROM "%(table)s" c '
+        'LEFT JOIN "%(table)s" p ON p.id = c."%(field)s" '
+        'WHERE COALESCE(c.write_date, c.create_date) > %%s '
+            'AND (c."left" IS NULL OR c."right" IS NULL '
+                'OR c."left" >= c."right" '
+                'OR (c."%(field)s" IS NOT NULL AND (p."left" IS NULL '
+                    'OR p."left" >= c."left" OR p."right" <= c."right")) '
+                'OR EXISTS (SELECT 1 FROM "%(table)s" a '
+                    'WHERE a."left" < c."left" AND a."right" > c."right" '
+                        'AND (p.id IS NULL OR a."left" > p."left"))) '
+        'ORDER BY c.id' % {
+            'table': table,
+            'field': field,
+            }, (mark,))
+    pending = cr.fetchall()
+    print "  * %d misplaced nodes since %s" % (len(pending), mark)
+
+    if len(pending) > max_changes:
+        print "  * More than %d changes, running full rebuild" % max_changes
+        _parent_store_compute_bulk(cr, table, field)
+        _set_mark(cr, table, field, new_mark)
+        return True
+
+    # Parents must be placed before their children
+    moved = 0
+    while pending:
+        ids = set(id for id, _ in pending)
+        deferred = []
+        for id, parent in pending:
+            if parent in ids:
+                deferred.append((id, parent))
+            elif _update_tree(cr, table, field, id):
+                ids.discard(id)
+                moved += 1
+            else:
+                deferred = pending
+                break
+        if len(deferred) == len(pending):
+            print "  * Could not place %d nodes, running full rebuild" % (
+                len(deferred))
+            _parent_store_compute_bulk(cr, table, field)
+            break
+        pending = deferred
+
+    _set_mark(cr, table, field, new_mark)
+    print "  * %d subtrees moved in %.2fs" % (moved, time.time() - start)
+    return True
+
+
+def _parent_store_check(cr, table, field):
+    '''
+    Return the number of nodes whose "left" and "right" are not consistent
+    with the parent field.
+
+    Every node must lie strictly inside its parent and, comparing each node
+    with the previous sibling in "left" order with a window function,
+    siblings must not overlap. Gaps are allowed.
+    '''
+    cr.execute('SELECT COUNT(*) FROM ('
+            'SELECT c."left", c."right", c."%(field)s" AS parent, '
+                'p."left" AS parent_left, p."right" AS parent_right, '
+                'LAG(c."right") OVER (PARTITION BY c."%(field)s" '
+                    'ORDER BY c."left") AS previous_right '
+            'FROM "%(table)s" c '
+            'LEFT JOIN "%(table)s" p ON p.id = c."%(field)s") n '
+        'WHERE n."left" IS NULL OR n."right" IS NULL '
+            'OR n."left" >= n."right" '
+            'OR n.previous_right >= n."left" '
+            'OR (n.parent IS NOT NULL AND (n.parent_left >= n."left" '
+                'OR n.parent_right <= n."right"))' % {
+            'table': table,
+            'field': field,
+            })
+    return cr.fetchone()[0]
+
+
+def discover_tables(cr):
+    '''
+    Return the (table, field) pairs of all tables with "left" and "right"
+    columns. The parent field is the many2one of the model to itself found
+    in ir_model_field, preferring one named "parent".
+    '''
+    cr.execute('SELECT table_name, column_name '
+        'FROM information_schema.columns '
+        'WHERE table_schema = current_schema() '
+            'AND column_name IN (\'left\', \'right\', \'parent\')')
+    columns = {}
+    for table, column in cr.fetchall():
+        columns.setdefault(table, set()).add(column)
+    candidates = set(table for table, names in columns.iteritems()
+        if 'left' in names and 'right' in names)
+
+    fields = {}
+    if _table_exists(cr, 'ir_model_field'):
+        cr.execute('SELECT m.model, f.name FROM ir_model_field f '
+            'JOIN ir_model m ON m.id = f.model '
+            'WHERE f.ttype = \'many2one\' AND f.relation = m.model '
+            'ORDER BY m.model, f.name = \'parent\' DESC, f.name')
+        for model, name in cr.fetchall():
+            table = model.replace('.', '_')
+            if table in candidates:
+                fields.setdefault(table, name)
+    for table in candidates - set(fields):
+        if 'parent' in columns[table]:
+            fields[table] = 'parent'
+        else:
+            print "  * Parent field of table %s not found, skipping" % table
+    return sorted(fields.items())
+
+
+def _table_exists(cr, table):
+    cr.execute('SELECT 1 FROM information_schema.tables '
+        'WHERE table_schema = current_schema() AND table_name = %s', (table,))
+    return bool(cr.fetchone())
+
+
+def _rebuild_table(args):
+    '''
+    Worker of rebuild_tables: rebuilds one table on its own connection and
+    returns the captured output so tables do not interleave.
+    '''
+    connection_args, table, field, mode, max_changes, force = args
+    output = StringIO()
+    sys.stdout = output
+    start = time.time()
+    try:
+        connection = psycopg2.connect(**connection_args)
+        try:
+            cursor = connection.cursor()
+            print "calculating parent_left of table", table, "and field:", \
+                field
+            errors = _parent_store_check(cursor, table, field)
+            if not errors and not force:
+                print "  * Consistent, skipped"
+                status = 'skipped'
+            else:
+                print "  * %d inconsistent nodes" % errors
+                if mode == 'incremental':
+                    _parent_store_compute_incremental(cursor, table, field,
+                        max_changes)
+                else:
+                    _parent_store_compute_bulk(cursor, table, field)
+                connection.commit()
+                status = 'rebuilt'
+        finally:
+            connection.close()
+    except Exception, e:
+        print "  * Error: %s" % e
+        status = 'error'
+    print "  * Total (%s): %.2fs" % (mode, time.time() - start)
+    sys.stdout = sys.__stdout__
+    return table, status, output.getvalue()
+
+
+def rebuild_tables(connection_args, tables, mode='bulk', max_changes=1000,
+        jobs=4, force=False):
+    '''
+    Check and rebuild tables concurrently, one process and connection per
+    table and at most jobs at a time. Tables that are already consistent are
+    skipped unless force is set.
+    '''
+    start = time.time()
+    pool = multiprocessing.Pool(processes=min(jobs, len(tables)) or 1)
+    results = {}
+    try:
+        for table, status, output in pool.imap_unordered(_rebuild_table,
+                [(connection_args, table, field, mode, max_changes, force)
+                    for table, field in tables]):
+            sys.stdout.write(output)
+            results[status] = results.get(status, 0) + 1
+    finally:
+        pool.close()
+        pool.join()
+    print "%d tables in %.2fs: %s" % (len(tables), time.time() - start,
+        ', '.join('%d %s' % (v, k) for k, v in sorted(results.items())))
+
+
+def calc_parent_leftright(targetCR, mode='recursive', max_changes=1000):
 
     for table, field in tables:
         print "calculating parent_left of table", table, "and field:", field
-        _parent_store_compute(targetCR, table, field)
+        start = time.time()
+        if mode == 'bulk':
+            _parent_store_compute_bulk(targetCR, table, field)
+        elif mode == 'incremental':
+            _parent_store_compute_incremental(targetCR, table, field,
+                max_changes)
+        else:
+            _parent_store_compute(targetCR, table, field)
+        print "  * Total (%s): %.2fs" % (mode, time.time() - start)
+
 
+def parse_arguments(arguments):
+    usage = 'parent.py [options] [table:field ...]'
+    parser = OptionParser(usage=usage)
+    parser.add_option('-d', '--database', dest='database', default='project')
+    parser.add_option('', '--host', dest='host', default='localhost')
+    parser.add_option('-p', '--port', dest='port', type='int', default=5432)
+    parser.add_option('-u', '--user', dest='user', default='angel')
+    parser.add_option('', '--mode', dest='mode', choices=MODES,
+        default='recursive', help='Rebuild mode: %s' % ', '.join(MODES))
+    parser.add_option('', '--max-changes', dest='max_changes', type='int',
+        default=1000, help='Incremental mode runs a full rebuild when more '
+        'nodes than this have to be moved')
+    parser.add_option('', '--all', dest='all', action='store_true',
+        default=False, help='Rebuild every table with left and right columns')
+    parser.add_option('-j', '--jobs', dest='jobs', type='int',
+        help='Number of tables rebuilt concurrently, 4 by default with --all')
+    parser.add_option('', '--force', dest='force', action='store_true',
+        default=False, help='Rebuild tables that pass the consistency check')
+
+    (option, arguments) = parser.parse_args(arguments)
+
+    settings = Settings()
+    settings.database = option.database
+    settings.host = option.host
+    settings.port = option.port
+    settings.user = option.user
+    settings.mode = option.mode
+    settings.max_changes = option.max_changes
+    settings.all = option.all
+    settings.jobs = option.jobs
+    settings.force = option.force
+    settings.tables = []
+    for argument in arguments:
+        if not ':' in argument:
+            parser.error('Tables must be given as table:field')
+        settings.tables.append(tuple(argument.split(':', 1)))
+    return settings
 
 
 if __name__ == '__main__':
-    database = 'project'
-    database_type = 'postgresql'
-    password = 'admin'
-    print "hola"
-    redmineDB = psycopg2.connect(
-        dbname = database,
-        host = 'localhost',
-        port = 5432,
-        user = 'angel')
-
-    print "hola2"
+    settings = parse_arguments(sys.argv[1:])
+    if settings.tables:
+        tables = settings.tables
+
+    connection_args = {
+        'dbname': settings.database,
+        'host': settings.host,
+        'port': settings.port,
+        'user': settings.user,
+        }
+    redmineDB = psycopg2.connect(**connection_args)
+
     cursor = redmineDB.cursor()
-    calc_parent_leftright(cursor)
+    if settings.all or settings.jobs:
+        if settings.all:
+            tables = discover_tables(cursor)
+        redmineDB.close()
+        mode = settings.mode if settings.mode != 'recursive' else 'bulk'
+        rebuild_tables(connection_args, tables, mode, settings.max_changes,
+            settings.jobs or 4, settings.force)
+        sys.exit(0)
+
+    calc_parent_leftright(cursor, settings.mode, settings.max_changes)
 
     redmineDB.commit()
     redmineDB.close()
-
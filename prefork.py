@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+'''
+Pre-forking trytond server.
+
+The master process imports trytond, initializes the pool of the given
+databases and binds the listen addresses once. It then forks the workers,
+which share the loaded modules copy-on-write and accept connections on the
+inherited sockets. Workers that die are forked again. On SIGTERM the workers
+finish the requests they are serving and the master exits when all of them
+are gone.
+'''
+import os
+import gc
+import sys
+import time
+import errno
+import signal
+import socket
+import logging
+import logging.config
+import threading
+from optparse import OptionParser
+
+# Sections whose listen option is served, as in server.py
+LISTEN_SECTIONS = ('web', 'jsonrpc', 'xmlrpc', 'webdav')
+# Seconds a dead worker waits before being forked again
+RESPAWN_DELAY = 1
+# Not exported by the socket module of Python 2
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+logger = logging.getLogger('prefork')
+
+
+def parse_arguments(arguments):
+    parser = OptionParser(usage='prefork.py [options] -c <config_file>')
+    parser.add_option('-c', '--config', dest='config',
+        help='trytond configuration file')
+    parser.add_option('', '--logconf', dest='logconf',
+        help='Logging configuration file')
+    parser.add_option('-w', '--workers', dest='workers', type='int',
+        default=2, help='Number of worker processes')
+    parser.add_option('-d', '--database', dest='databases', action='append',
+        default=[], help='Database whose pool is loaded before forking, can '
+        'be repeated')
+    parser.add_option('', '--reuseport', dest='reuseport',
+        action='store_true', default=False, help='Each worker binds its own '
+        'socket with SO_REUSEPORT and the kernel balances the connections '
+        'among them instead of all accepting on the same one')
+    parser.add_option('', '--timeout', dest='timeout', type='int',
+        default=30, help='Seconds workers are given to finish their requests '
+        'on shutdown')
+    parser.add_option('', '--trytond', dest='trytond',
+        help='Directory containing the trytond package')
+    (option, arguments) = parser.parse_args(arguments)
+    if not option.config:
+        parser.error('config file is required')
+    if option.workers < 1:
+        parser.error('at least one worker is required')
+    return option
+
+
+def memory_usage():
+    '''
+    Returns the resident memory of the current process in kB.
+    '''
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return 0
+
+
+def listen_addresses(config):
+    '''
+    Returns the (host, port) of the listen options of config.
+    '''
+    addresses = []
+    for section in LISTEN_SECTIONS:
+        if not config.has_option(section, 'listen'):
+            continue
+        for value in config.get(section, 'listen').split(','):
+            host, port = value.strip().rsplit(':', 1)
+            host = host.strip('[]')
+            if host == '*':
+                host = '0.0.0.0'
+            if (host, int(port)) not in addresses:
+                addresses.append((host, int(port)))
+    return addresses
+
+
+def bind(host, port, backlog=128, reuseport=False, listen=True):
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuseport:
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    if listen:
+        sock.listen(backlog)
+    return sock
+
+
+def close_databases():
+    '''
+    Closes the database connections opened while loading the pool so they
+    are not shared by the workers, each one opens its own on first use.
+    '''
+    from trytond import backend
+    Database = backend.get('Database')
+    databases = getattr(Database, '_databases', {})
+    # Instances are kept per process since trytond 5.0
+    if os.getpid() in databases:
+        databases = databases[os.getpid()]
+    for database in databases.values():
+        database.close()
+    databases.clear()
+
+
+def load(option):
+    '''
+    Imports trytond and initializes the pool of the databases. Returns the
+    WSGI application.
+    '''
+    if option.trytond:
+        sys.path.insert(0, option.trytond)
+    from trytond.config import config
+    config.update_etc(option.config)
+    if option.logconf:
+        logging.config.fileConfig(option.logconf)
+    else:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - '
+            '%(name)s - %(levelname)s - %(message)s')
+
+    start = time.time()
+    from trytond.pool import Pool
+    from trytond.application import app
+    Pool.start()
+    for database in option.databases:
+        Pool(database).init()
+    close_databases()
+    # Objects alive now are never collected so the collector does not
+    # write to their pages in the workers
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+    logger.info('trytond and %d databases loaded in %.1fs, %d MB resident',
+        len(option.databases), time.time() - start, memory_usage() // 1024)
+    return app, listen_addresses(config)
+
+
+def serve(app, sockets, number, reuseport=False, timeout=30):
+    '''
+    Worker: serves app on the inherited sockets, or on its own sockets bound
+    to the same addresses with reuseport, until SIGTERM or until the master
+    dies, and waits up to timeout seconds for the requests being served.
+    '''
+    from werkzeug.serving import make_server
+
+    start = time.time()
+    master = os.getppid()
+    if reuseport:
+        sockets = [bind(*x.getsockname()[:2], reuseport=True)
+            for x in sockets]
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    servers = []
+    for sock in sockets:
+        host, port = sock.getsockname()[:2]
+        server = make_server(host, port, app, threaded=True,
+            fd=sock.fileno())
+        # werkzeug uses daemon threads, they would be killed on exit
+        server.daemon_threads = False
+        servers.append(server)
+    for server in servers:
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+    logger.info('worker %d (pid %d) ready in %.2fs', number, os.getpid(),
+        time.time() - start)
+    while not stop.is_set():
+        # Event.wait() without timeout does not return on signals
+        stop.wait(1)
+        if os.getppid() != master:
+            # Orphan workers would keep the listening sockets
+            logger.warning('worker %d (pid %d): master died, stopping',
+                number, os.getpid())
+            break
+    for server in servers:
+        server.shutdown()
+    # Let the threads serving requests finish
+    limit = time.time() + timeout
+    for thread in threading.enumerate():
+        if thread is not threading.current_thread() and not thread.daemon:
+            thread.join(max(0, limit - time.time()))
+
+
+def run(option):
+    start = time.time()
+    app, addresses = load(option)
+    if not addresses:
+        logger.error('no listen address found in %s', option.config)
+        return 1
+    # With reuseport the master only binds to reserve the addresses, only
+    # listening sockets get connections
+    sockets = [bind(host, port, reuseport=option.reuseport,
+            listen=not option.reuseport) for host, port in addresses]
+    logger.info('listening on %s', ', '.join('%s:%d' % x for x in addresses))
+
+    workers = {}
+    running = [True]
+
+    def stop(signum, frame):
+        running[0] = False
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    def spawn(number):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                serve(app, sockets, number, option.reuseport,
+                    option.timeout)
+            except Exception:
+                logger.exception('worker %d failed', number)
+                status = 1
+            finally:
+                os._exit(status)
+        workers[pid] = number
+
+    for number in xrange(1, option.workers + 1):
+        spawn(number)
+    logger.info('%d workers forked %.1fs after start', option.workers,
+        time.time() - start)
+
+    while running[0]:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError, e:
+            if e.errno not in (errno.EINTR, errno.ECHILD):
+                raise
+            pid = 0
+        if not pid:
+            time.sleep(0.5)
+            continue
+        number = workers.pop(pid, None)
+        if number is None or not running[0]:
+            continue
+        logger.warning('worker %d (pid %d) exited with status %d, forking it '
+            'again', number, pid, status)
+        time.sleep(RESPAWN_DELAY)
+        spawn(number)
+
+    logger.info('stopping %d workers', len(workers))
+    for pid in workers:
+        os.kill(pid, signal.SIGTERM)
+    limit = time.time() + option.timeout + 5
+    while workers and time.time() < limit:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError, e:
+            if e.errno == errno.ECHILD:
+                break
+            pid = 0
+        if pid:
+            workers.pop(pid, None)
+        else:
+            time.sleep(0.2)
+    for pid in workers:
+        logger.warning('worker pid %d did not stop, killing it', pid)
+        os.kill(pid, signal.SIGKILL)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(run(parse_arguments(sys.argv[1:])))
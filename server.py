@@ -29,6 +29,10 @@ import signal
 import glob
 import datetime
 import shutil
+import fnmatch
+import json
+import select
+from multiprocessing.pool import ThreadPool
 from urlparse import urlparse
 import re
 try:
@@ -41,7 +45,8 @@ except ImportError:
 # krestart is the same as restart but will execute kill after
 # stop() and before the next start()
 ACTIONS = ('start', 'stop', 'restart', 'status', 'kill', 'krestart', 'config',
-    'ps', 'db', 'top', 'backtrace', 'console')
+    'ps', 'db', 'top', 'backtrace', 'console', 'queries', 'indexes',
+    'rolling-restart', 'memory')
 
 # Start Printing Tables
 # http://ginstrom.com/scribbles/2007/09/04/pretty-printing-a-table-in-python/
@@ -235,44 +240,480 @@ def console(settings):
     ipshell()
 
 
-def db():
+DB_COLUMNS = ('port', 'name', 'owner', 'size', 'age', 'connections', 'idle',
+    'transactions')
+
+# Columns sorted in descending order by --sort
+DB_DESCENDING = ('size', 'age', 'connections', 'idle', 'transactions')
+
+# Sizes are only computed for databases we can connect to as
+# pg_database_size() fails otherwise. Age is taken from the modification time
+# of the PG_VERSION file of the database directory, which requires superuser
+# or pg_read_server_files privileges.
+DB_QUERY = """
+    SELECT
+        d.datname,
+        pg_get_userbyid(d.datdba),
+        CASE WHEN has_database_privilege(d.oid, 'CONNECT')
+            THEN pg_database_size(d.oid) END,
+        %s,
+        COALESCE(a.connections, 0),
+        EXTRACT(EPOCH FROM NOW() - a.last_activity)::int,
+        s.xact_commit + s.xact_rollback
+    FROM pg_database d
+    LEFT JOIN (
+        SELECT datid, COUNT(*) AS connections,
+            MAX(COALESCE(state_change, backend_start)) AS last_activity
+        FROM pg_stat_activity
+        GROUP BY datid) a ON a.datid = d.oid
+    LEFT JOIN pg_stat_database s ON s.datid = d.oid
+    WHERE NOT d.datistemplate
+    """
+DB_AGE = ("EXTRACT(EPOCH FROM NOW() - (pg_stat_file('base/' || d.oid || "
+    "'/PG_VERSION')).modification)::int")
+
+def format_size(size):
+    if size is None:
+        return '-'
+    for unit in ('bytes', 'kB', 'MB', 'GB'):
+        if size < 10240:
+            return '%d %s' % (size, unit)
+        size /= 1024
+    return '%d TB' % size
+
+def format_age(seconds):
+    if seconds is None:
+        return '-'
+    for unit, length in (('d', 86400), ('h', 3600), ('m', 60)):
+        if seconds >= length:
+            return '%d%s' % (seconds // length, unit)
+    return '%ds' % seconds
+
+def database_stats(port=None):
+    """
+    Returns a dictionary per database of the PostgreSQL server listening
+    on port with the DB_COLUMNS values.
+    """
     import psycopg2
-    import psycopg2.extras
-    database = psycopg2.connect("dbname=%s"%('template1'))
-    cursor = database.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
-    # Databases
-    cursor.execute('SELECT datname FROM pg_database')
-    records = cursor.fetchall()
-    databases = [x['datname'] for x in records]
+    dsn = 'dbname=template1'
+    if port:
+        dsn += ' port=%s' % port
+    connection = psycopg2.connect(dsn)
+    try:
+        cursor = connection.cursor()
+        try:
+            cursor.execute(DB_QUERY % DB_AGE)
+        except psycopg2.Error:
+            connection.rollback()
+            cursor.execute(DB_QUERY % 'NULL')
+        return [dict(zip(DB_COLUMNS, (port,) + row))
+            for row in cursor.fetchall()]
+    finally:
+        connection.close()
 
-    data = []
-    data.append(databases[:])
+def db(settings):
+    """
+    Prints size, owner, age, connections, idle time since the last activity
+    and number of transactions of all databases of the servers listening
+    on settings.ports, which are queried concurrently.
+    """
+    def scan(port):
+        try:
+            return database_stats(port)
+        except Exception, e:
+            print >>sys.stderr, 'Port %s: %s' % (port or 'default', e)
+            return []
 
-    sizes = []
-    # Size
+    ports = settings.ports or [None]
+    pool = ThreadPool(len(ports))
+    try:
+        databases = sum(pool.map(scan, ports), [])
+    finally:
+        pool.close()
+        pool.join()
+
+    if settings.filter:
+        if any(x in settings.filter for x in '*?['):
+            databases = [x for x in databases
+                if fnmatch.fnmatch(x['name'], settings.filter)]
+        else:
+            databases = [x for x in databases
+                if settings.filter in x['name']]
+    sort = settings.sort or 'name'
+    if sort not in DB_COLUMNS[1:]:
+        print 'Sort column must be one of %s.' % ', '.join(DB_COLUMNS[1:])
+        sys.exit(1)
+    # Databases without value (no privileges) are kept at the end
+    databases = (sorted([x for x in databases if x[sort] is not None],
+            key=lambda x: x[sort], reverse=sort in DB_DESCENDING)
+        + [x for x in databases if x[sort] is None])
+
+    if settings.json:
+        print json.dumps(databases, indent=4)
+        return
+    table = [['Database', 'Owner', 'Size', 'Age', 'Connections', 'Idle',
+            'Transactions']]
+    if len(ports) > 1:
+        table[0].insert(1, 'Port')
     for database in databases:
-        cursor.execute("SELECT pg_size_pretty(pg_database_size('%s')) AS size"
-            % database);
-        size = cursor.fetchone()['size']
-        sizes.append(size)
-        #print "Database: %s, Size: %s" % (database, size)
-    data.append(sizes)
-
-    pprint_table(transpose(data))
-
-    # Activity
-    #print "Activity:"
-    #cursor.execute('SELECT * FROM pg_stat_activity')
-    #print dir(cursor)
-    #records = cursor.fetchall()
-    #for record in records:
-    #    line = []
-    #    for field in record.keys():
-    #        line.append('%s=%s' % (field, record[field]))
-    #    print ' '.join(line)
-
-def fork_and_call(call, pidfile=None, logfile=None, cwd=None):
+        row = [database['name'], database['owner'],
+            format_size(database['size']), format_age(database['age']),
+            database['connections'], format_age(database['idle']),
+            '-' if database['transactions'] is None
+            else database['transactions']]
+        if len(ports) > 1:
+            row.insert(1, database['port'])
+        table.append(row)
+    pprint_table(table)
+
+QUERY_SORTS = ('total', 'mean', 'calls', 'rows')
+
+# Tables with less live rows are not worth an index
+INDEX_MIN_ROWS = 10000
+
+TABLE_RE = re.compile(r'\b(?:FROM|JOIN|UPDATE|INTO)\s+"?([a-z_][a-z0-9_]*)"?',
+    re.IGNORECASE)
+
+def connect_database(settings, config):
+    """
+    Returns an autocommit connection to settings.database using the host,
+    port and credentials of the database uri of the configuration.
+    """
+    import psycopg2
+    from common import database_dsn
+
+    if not settings.database:
+        print 'No database specified.'
+        sys.exit(1)
+    connection = psycopg2.connect(database_dsn(config.get('database.uri', ''),
+            settings.database))
+    connection.autocommit = True
+    return connection
+
+def statement_stats(cursor):
+    """
+    Returns {query: [calls, total time in ms, rows]} of the statements of
+    the current database in pg_stat_statements.
+    """
+    cursor.execute('SHOW server_version_num')
+    # total_time was split in total_plan_time and total_exec_time in 13
+    if int(cursor.fetchone()[0]) >= 130000:
+        total = 'total_exec_time'
+    else:
+        total = 'total_time'
+    cursor.execute('SELECT query, SUM(calls), SUM(%s), SUM(rows) '
+        'FROM pg_stat_statements '
+        'WHERE dbid = (SELECT oid FROM pg_database '
+            'WHERE datname = current_database()) '
+        'GROUP BY query' % total)
+    return dict((query, [calls, time, rows])
+        for query, calls, time, rows in cursor.fetchall())
+
+def queries(settings, config):
+    """
+    Prints the statements of settings.database with the highest time,
+    calls or rows according to pg_stat_statements and the models of the
+    tables they use. If settings.interval is set only the statements
+    executed between two samples taken that number of seconds apart are
+    shown.
+    """
+    sort = settings.sort or 'total'
+    if sort not in QUERY_SORTS:
+        print 'Sort column must be one of %s.' % ', '.join(QUERY_SORTS)
+        sys.exit(1)
+
+    connection = connect_database(settings, config)
+    try:
+        cursor = connection.cursor()
+        cursor.execute("SELECT 1 FROM pg_extension "
+            "WHERE extname = 'pg_stat_statements'")
+        if not cursor.fetchone():
+            print ('pg_stat_statements is not installed in %s. Add it to '
+                'shared_preload_libraries and run CREATE EXTENSION '
+                'pg_stat_statements.' % settings.database)
+            sys.exit(1)
+        cursor.execute("SELECT model FROM ir_model")
+        models = dict((x.replace('.', '_'), x) for x, in cursor.fetchall())
+
+        stats = statement_stats(cursor)
+        if settings.interval:
+            time.sleep(settings.interval)
+            previous, stats = stats, statement_stats(cursor)
+            for query, values in stats.items():
+                old = previous.get(query, [0, 0, 0])
+                values[:] = [x - y for x, y in zip(values, old)]
+                if not values[0]:
+                    del stats[query]
+    finally:
+        connection.close()
+
+    statements = []
+    model_times = {}
+    for query, (calls, total, rows) in stats.iteritems():
+        calls, total, rows = int(calls), float(total), int(rows)
+        tables = sorted(set(TABLE_RE.findall(query)))
+        names = [models.get(x, x) for x in tables]
+        for name in names:
+            model_times[name] = model_times.get(name, 0) + total
+        statements.append({
+                'query': query,
+                'calls': calls,
+                'total': total,
+                'mean': total / calls if calls else 0,
+                'rows': rows,
+                'models': names,
+                })
+    statements.sort(key=lambda x: x[sort], reverse=True)
+    statements = statements[:settings.limit]
+    hot_models = sorted(model_times.items(), key=lambda x: x[1],
+        reverse=True)[:settings.limit]
+
+    if settings.json:
+        print json.dumps({
+                'statements': statements,
+                'models': [{'model': x, 'total': y} for x, y in hot_models],
+                }, indent=4)
+        return
+
+    table = [['Query', 'Models', 'Total ms', 'Mean ms', 'Calls', 'Rows']]
+    for statement in statements:
+        query = ' '.join(statement['query'].split())
+        if len(query) > 60:
+            query = query[:57] + '...'
+        table.append([query, ','.join(statement['models']),
+                '%.1f' % statement['total'], '%.2f' % statement['mean'],
+                statement['calls'], statement['rows']])
+    pprint_table(table)
+    print
+    table = [['Model', 'Total ms']]
+    for model, total in hot_models:
+        table.append([model, '%.1f' % total])
+    pprint_table(table)
+
+def index_advice(cursor, limit):
+    """
+    Returns (create, drop) lists of suggestions. create has the many2one
+    columns without index of the tables with at least INDEX_MIN_ROWS rows
+    read mostly with sequential scans, ranked by the rows those scans read.
+    drop has the indexes never used that do not enforce a constraint,
+    largest first.
+    """
+    cursor.execute("SELECT relname, seq_scan, seq_tup_read, "
+            "COALESCE(idx_scan, 0), n_live_tup, "
+            "pg_total_relation_size(relid) "
+        "FROM pg_stat_user_tables "
+        "WHERE schemaname = current_schema() "
+            "AND n_live_tup >= %s AND seq_scan > COALESCE(idx_scan, 0) "
+        "ORDER BY seq_tup_read DESC", (INDEX_MIN_ROWS,))
+    tables = cursor.fetchall()
+
+    cursor.execute("SELECT t.relname, a.attname "
+        "FROM pg_index i "
+        "JOIN pg_class t ON t.oid = i.indrelid "
+        "JOIN pg_namespace n ON n.oid = t.relnamespace "
+        "JOIN pg_attribute a ON a.attrelid = t.oid "
+            "AND a.attnum = i.indkey[0] "
+        "WHERE n.nspname = current_schema()")
+    indexed = set(cursor.fetchall())
+    cursor.execute("SELECT table_name, column_name "
+        "FROM information_schema.columns "
+        "WHERE table_schema = current_schema()")
+    columns = set(cursor.fetchall())
+    cursor.execute("SELECT m.model, f.name "
+        "FROM ir_model_field f JOIN ir_model m ON m.id = f.model "
+        "WHERE f.ttype = 'many2one'")
+    many2ones = {}
+    for model, field in cursor.fetchall():
+        table = model.replace('.', '_')
+        if (table, field) in columns and (table, field) not in indexed:
+            many2ones.setdefault(table, []).append((model, field))
+
+    create = []
+    for table, seq_scan, seq_tup_read, idx_scan, rows, size in tables:
+        if table not in many2ones:
+            continue
+        for model, field in sorted(many2ones[table]):
+            create.append({
+                    'table': table,
+                    'model': model,
+                    'column': field,
+                    'seq_scan': seq_scan,
+                    'seq_tup_read': seq_tup_read,
+                    'idx_scan': idx_scan,
+                    'rows': rows,
+                    'size': size,
+                    'sql': 'CREATE INDEX CONCURRENTLY "%s_%s_index" '
+                        'ON "%s" ("%s");' % (table, field, table, field),
+                    })
+        if len(set(x['table'] for x in create)) >= limit:
+            break
+
+    cursor.execute("SELECT s.relname, s.indexrelname, "
+            "pg_relation_size(s.indexrelid) "
+        "FROM pg_stat_user_indexes s "
+        "JOIN pg_index i ON i.indexrelid = s.indexrelid "
+        "WHERE s.schemaname = current_schema() AND s.idx_scan = 0 "
+            "AND NOT i.indisunique AND NOT i.indisprimary "
+            "AND NOT EXISTS (SELECT 1 FROM pg_constraint c "
+                "WHERE c.conindid = s.indexrelid) "
+        "ORDER BY pg_relation_size(s.indexrelid) DESC "
+        "LIMIT %s", (limit,))
+    drop = [{
+            'table': table,
+            'index': index,
+            'size': size,
+            'sql': 'DROP INDEX CONCURRENTLY "%s";' % index,
+            } for table, index, size in cursor.fetchall()]
+    return create, drop
+
+def indexes(settings, config):
+    """
+    Prints as SQL the indexes worth creating on many2one columns of tables
+    read with sequential scans and the unused indexes worth dropping.
+    """
+    connection = connect_database(settings, config)
+    try:
+        cursor = connection.cursor()
+        create, drop = index_advice(cursor, settings.limit)
+        cursor.execute("SELECT stats_reset FROM pg_stat_database "
+            "WHERE datname = current_database()")
+        stats_reset = cursor.fetchone()[0]
+    finally:
+        connection.close()
+
+    if settings.json:
+        print json.dumps({
+                'create': create,
+                'drop': drop,
+                'stats_reset': stats_reset and stats_reset.isoformat(),
+                }, indent=4)
+        return
+    print '-- Statistics of %s since %s' % (settings.database,
+        stats_reset or 'the cluster was created')
+    print '-- Many2one columns without index of tables mostly read with'
+    print '-- sequential scans, check that they are used in searches'
+    table = None
+    for suggestion in create:
+        if suggestion['table'] != table:
+            table = suggestion['table']
+            print
+            print ('-- %(table)s (%(model)s): %(rows)s rows, %(seq_scan)s '
+                'sequential scans reading %(seq_tup_read)s rows, '
+                '%(idx_scan)s index scans' % suggestion)
+            print '-- size: %s' % format_size(suggestion['size'])
+        print suggestion['sql']
+    print
+    print '-- Indexes not used since the statistics were reset'
+    for suggestion in drop:
+        print
+        print '-- %s: %s' % (suggestion['table'],
+            format_size(suggestion['size']))
+        print suggestion['sql']
+
+MEMORY_FIELDS = ('Rss', 'Pss', 'Shared_Clean', 'Shared_Dirty',
+    'Private_Clean', 'Private_Dirty')
+
+def process_memory(pid):
+    """
+    Returns the memory counters of pid in kB from /proc/<pid>/smaps_rollup,
+    summing /proc/<pid>/smaps on kernels older than 4.14.
+    """
+    values = dict.fromkeys(MEMORY_FIELDS, 0)
+    filename = '/proc/%d/smaps_rollup' % pid
+    if not os.path.exists(filename):
+        filename = '/proc/%d/smaps' % pid
+    with open(filename, 'r') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in values:
+                values[key] += int(value.split()[0])
+    return values
+
+def process_stat(pid):
+    """
+    Returns the parent pid and seconds since pid started.
+    """
+    with open('/proc/%d/stat' % pid, 'r') as f:
+        # The command may contain spaces and parenthesis
+        fields = f.read().rpartition(')')[2].split()
+    with open('/proc/uptime', 'r') as f:
+        uptime = float(f.read().split()[0])
+    started = float(fields[19]) / os.sysconf('SC_CLK_TCK')
+    return int(fields[1]), int(uptime - started)
+
+def child_pids(pid):
+    children = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            if process_stat(int(name))[0] == pid:
+                children.append(int(name))
+        except (IOError, OSError):
+            # Process finished meanwhile
+            pass
+    return sorted(children)
+
+def memory(settings):
+    """
+    Shows resident (RSS) and proportional (PSS) memory of the Tryton server
+    processes. PSS divides shared pages among the processes sharing them so
+    its total is the real footprint of the server, which is what prefork
+    workers sharing the loaded pool reduce.
+    """
+    processes = []
+    for pidfile in settings.pidfiles:
+        pid = read_pid(pidfile)
+        if pid is None or not pid_running(pid):
+            continue
+        name = os.path.basename(pidfile)
+        processes.append((pid, name))
+        for child in child_pids(pid):
+            processes.append((child, '%s worker' % name))
+    rows = []
+    for pid, name in processes:
+        try:
+            values = process_memory(pid)
+            uptime = process_stat(pid)[1]
+        except (IOError, OSError):
+            continue
+        rows.append({
+                'pid': pid,
+                'process': name,
+                'uptime': uptime,
+                'rss': values['Rss'] * 1024,
+                'pss': values['Pss'] * 1024,
+                'shared': (values['Shared_Clean']
+                    + values['Shared_Dirty']) * 1024,
+                'private': (values['Private_Clean']
+                    + values['Private_Dirty']) * 1024,
+                })
+    model = ('prefork' if settings.prefork else 'independent processes')
+    if settings.json:
+        print json.dumps({
+                'model': model,
+                'workers': settings.workers,
+                'processes': rows,
+                }, indent=2)
+        return
+    if not rows:
+        print 'No Tryton server running.'
+        return
+    print 'Model: %s, %d workers' % (model, settings.workers)
+    table = [['Pid', 'Process', 'Uptime', 'RSS', 'PSS', 'Shared', 'Private']]
+    for row in rows:
+        table.append([str(row['pid']), row['process'],
+                format_age(row['uptime']),
+                format_size(row['rss']), format_size(row['pss']),
+                format_size(row['shared']), format_size(row['private'])])
+    table.append(['', 'Total', '', format_size(sum(x['rss'] for x in rows)),
+            format_size(sum(x['pss'] for x in rows)),
+            format_size(sum(x['shared'] for x in rows)),
+            format_size(sum(x['private'] for x in rows))])
+    pprint_table(table)
+
+def fork_and_call(call, pidfile=None, logfile=None, cwd=None, env=None):
     # do the UNIX double-fork magic, see Stevens' "Advanced
     # Programming in the UNIX Environment" for details (ISBN 0201563177)
     try:
@@ -301,7 +742,8 @@ def fork_and_call(call, pidfile=None, logfile=None, cwd=None):
     else:
         output = None
     # do stuff
-    process = subprocess.Popen(call, stdout=output, stderr=output, cwd=cwd)
+    process = subprocess.Popen(call, stdout=output, stderr=output, cwd=cwd,
+        env=env)
 
     if pidfile:
         file = open(pidfile, 'w')
@@ -311,6 +753,49 @@ def fork_and_call(call, pidfile=None, logfile=None, cwd=None):
     # all done
     os._exit(os.EX_OK)
 
+def fork_and_run(function, pidfile=None, logfile=None):
+    """
+    Runs function in a daemon process the same way fork_and_call runs a
+    command. The pid file is removed when function returns.
+    """
+    try:
+        pid = os.fork()
+        if pid > 0:
+            return
+    except OSError, e:
+        print >>sys.stderr, "fork #1 failed: %d (%s)" % (e.errno, e.strerror)
+        sys.exit(1)
+
+    os.setsid()
+
+    try:
+        pid = os.fork()
+        if pid > 0:
+            sys.exit(0)
+    except OSError, e:
+        print >>sys.stderr, "fork #2 failed: %d (%s)" % (e.errno, e.strerror)
+        sys.exit(1)
+
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+    if logfile:
+        output = os.open(logfile, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+    else:
+        output = devnull
+    os.dup2(output, 1)
+    os.dup2(output, 2)
+
+    if pidfile:
+        file = open(pidfile, 'w')
+        file.write(str(os.getpid()))
+        file.close()
+    try:
+        function()
+    finally:
+        if pidfile and os.path.exists(pidfile):
+            os.remove(pidfile)
+        os._exit(os.EX_OK)
+
 class Settings(dict):
     def __init__(self, *args, **kw):
         super(Settings, self).__init__(*args, **kw)
@@ -318,16 +803,38 @@ class Settings(dict):
 
 def parse_arguments(arguments, root, extra=True):
     parser = optparse.OptionParser(usage='server.py [options] start|stop|'
-        'restart|status|kill|krestart|config|ps|db|top|console '
+        'restart|status|kill|krestart|config|ps|db|top|console|queries|'
+        'indexes|rolling-restart|memory '
         '[database [-- parameters]]')
     parser.add_option('', '--config', dest='config',
         help='(it will search: server-config_name.cfg')
     parser.add_option('', '--config-file', dest='config_file', help='')
     parser.add_option('', '--no-tail', action='store_true', help='')
+    parser.add_option('', '--supervise', action='store_true', help='Start '
+        'the workers under a resident supervisor that restarts them when '
+        'they die and only routes requests to ready workers')
     parser.add_option('', '--server-help', action='store_true', help='')
     parser.add_option('', '--verbose', action='store_true', help='This verbose'
         ' is only for the server.py execution, it is not the tryton verbose, '
         'it has to be defined in the server config file.')
+    parser.add_option('', '--port', dest='ports', action='append',
+        default=[], help='PostgreSQL port scanned by db, can be repeated')
+    parser.add_option('', '--sort', dest='sort', help='Column db output is '
+        'sorted by: %s. Column queries output is sorted by: %s' % (
+            ', '.join(DB_COLUMNS[1:]), ', '.join(QUERY_SORTS)))
+    parser.add_option('', '--filter', dest='filter', help='Only show '
+        'databases matching this pattern or containing this text in db')
+    parser.add_option('', '--json', action='store_true', help='Print db, '
+        'queries, indexes and memory output as JSON')
+    parser.add_option('', '--limit', dest='limit', type='int', default=20,
+        help='Number of statements shown by queries and of tables and '
+        'indexes shown by indexes')
+    parser.add_option('', '--interval', dest='interval', type='float',
+        help='Show the statistics of queries executed in this number of '
+        'seconds instead of the totals since the last reset')
+    parser.add_option('', '--timeout', dest='timeout', type='int',
+        default=30, help='Seconds each worker is given to finish its '
+        'requests on rolling-restart before it is killed')
     (option, arguments) = parser.parse_args(arguments)
     # Remove first argument because it's application name
     arguments.pop(0)
@@ -365,6 +872,14 @@ def parse_arguments(arguments, root, extra=True):
                 break
 
     settings.tail = not option.no_tail
+    settings.supervise = bool(option.supervise)
+    settings.ports = option.ports
+    settings.sort = option.sort
+    settings.filter = option.filter
+    settings.json = bool(option.json)
+    settings.limit = option.limit
+    settings.interval = option.interval
+    settings.timeout = option.timeout
 
     if settings.verbose:
         print "Configuration file: %s" % settings.config
@@ -396,6 +911,9 @@ def parse_arguments(arguments, root, extra=True):
 
     settings.pidfiles = [os.path.join(root, 'trytond.pid')]
     settings.pidfile_jasper = os.path.join(root, 'jasper.pid')
+    settings.pidfile_supervisor = os.path.join(root, 'supervisor.pid')
+    settings.supervisor_socket = os.path.join(root, 'supervisor.sock')
+    settings.workers_file = os.path.join(root, 'workers.json')
     settings.logfile = os.path.join(root, 'server.log')
 
     settings.extra_arguments = []
@@ -416,6 +934,196 @@ def take_free_port(num=1):
         n += 1
     return ports
 
+# Not exported by the socket module of Python 2
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+# Used by optional.workers = auto: workers per available CPU, part of the
+# memory budget used by the workers, memory of a worker until it has been
+# measured, seconds a worker must run before its memory is measured and
+# connections a trytond process may open (database.maxconn default)
+WORKERS_PER_CPU = 2
+MEMORY_FRACTION = 0.75
+DEFAULT_WORKER_MEMORY = 300 * 1024 * 1024
+WARMUP_TIME = 600
+DEFAULT_MAXCONN = 64
+
+_cpu_count = []
+
+def cpu_count():
+    if not _cpu_count:
+        import multiprocessing
+        _cpu_count.append(multiprocessing.cpu_count())
+    return _cpu_count[0]
+
+def read_first_line(filename):
+    try:
+        with open(filename, 'r') as f:
+            return f.readline().strip()
+    except IOError:
+        return None
+
+def cgroup_cpus():
+    """
+    Returns the CPUs allowed by the cgroup CPU quota or None if there is no
+    quota.
+    """
+    value = read_first_line('/sys/fs/cgroup/cpu.max')
+    if value:
+        quota, _, period = value.partition(' ')
+    else:
+        quota = read_first_line('/sys/fs/cgroup/cpu/cpu.cfs_quota_us')
+        period = read_first_line('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+    if not quota or not period or quota in ('max', '-1'):
+        return None
+    return float(quota) / float(period)
+
+def memory_budget():
+    """
+    Returns the memory limit of the cgroup, or the total memory of the host
+    if it is lower or there is no limit, in bytes and where it comes from.
+    """
+    total = None
+    with open('/proc/meminfo', 'r') as f:
+        for line in f:
+            if line.startswith('MemTotal:'):
+                total = int(line.split()[1]) * 1024
+    for filename in ('/sys/fs/cgroup/memory.max',
+            '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        value = read_first_line(filename)
+        if value and value.isdigit() and int(value) < total:
+            return int(value), 'cgroup limit'
+    return total, 'host memory'
+
+def worker_memory(settings, pidfiles):
+    """
+    Returns the mean PSS of the running server processes of pidfiles that
+    have been running for WARMUP_TIME, stored in workers-memory so the last
+    measure is used when they are stopped. Returns the stored value or
+    DEFAULT_WORKER_MEMORY if there is no measure.
+    """
+    filename = os.path.join(settings.root, 'workers-memory')
+    sizes = []
+    for pidfile in pidfiles:
+        pid = read_pid(pidfile)
+        if pid is None or not pid_running(pid):
+            continue
+        for pid in [pid] + child_pids(pid):
+            try:
+                if process_stat(pid)[1] >= WARMUP_TIME:
+                    sizes.append(process_memory(pid)['Pss'] * 1024)
+            except (IOError, OSError):
+                pass
+    if sizes:
+        size = sum(sizes) // len(sizes)
+        with open(filename, 'w') as f:
+            f.write(str(size))
+        return size, 'measured on %d processes' % len(sizes)
+    value = read_first_line(filename)
+    if value and value.isdigit():
+        return int(value), 'last measure'
+    return DEFAULT_WORKER_MEMORY, 'default, no measure yet'
+
+def connection_headroom(values, database):
+    """
+    Returns the connections trytond may open: max_connections minus the
+    reserved ones and those used by other databases, or None if PostgreSQL
+    can not be queried.
+    """
+    uri = values.get('database.uri', '')
+    if not uri.startswith('postgresql'):
+        return None
+    try:
+        import psycopg2
+    except ImportError:
+        return None
+    from common import database_dsn
+
+    try:
+        connection = psycopg2.connect(database_dsn(uri, 'template1'))
+    except psycopg2.Error:
+        return None
+    try:
+        cursor = connection.cursor()
+        cursor.execute('SELECT current_setting(\'max_connections\')::int '
+                '- current_setting(\'superuser_reserved_connections\')::int '
+                '- (SELECT COUNT(*) FROM pg_stat_activity '
+                    'WHERE datname IS DISTINCT FROM %s)', (database,))
+        return cursor.fetchone()[0]
+    finally:
+        connection.close()
+
+def auto_workers(settings, values):
+    """
+    Returns the number of workers allowed by the CPUs, the memory budget
+    and the PostgreSQL connections available, printing how it was chosen.
+    """
+    limits = []
+
+    cpus = cpu_count()
+    quota = cgroup_cpus()
+    reason = '%d CPUs' % cpus
+    if quota is not None and quota < cpus:
+        cpus = max(1, int(round(quota)))
+        reason += ', cgroup quota of %.1f CPUs' % quota
+    limits.append((cpus * WORKERS_PER_CPU, '%s, %d workers per CPU' % (
+                reason, WORKERS_PER_CPU)))
+
+    budget, source = memory_budget()
+    pidfile = values.get('optional.pidfile', settings.pidfiles[0])
+    size, measure = worker_memory(settings, [pidfile]
+        + sorted(glob.glob(pidfile + '.*')))
+    limits.append((int(budget * MEMORY_FRACTION // size),
+            '%d%% of %s (%s) / %s per worker (%s)' % (
+                MEMORY_FRACTION * 100, format_size(budget), source,
+                format_size(size), measure)))
+
+    headroom = connection_headroom(values, settings.database)
+    if headroom is not None:
+        maxconn = int(values.get('database.maxconn', DEFAULT_MAXCONN))
+        limits.append((headroom // maxconn,
+                '%d PostgreSQL connections available / %d per worker' % (
+                    headroom, maxconn)))
+    else:
+        print '[WORKERS] PostgreSQL not available, connections not checked'
+
+    workers = max(1, min(x for x, _ in limits))
+    for limit, reason in limits:
+        print '[WORKERS] %3d: %s' % (limit, reason)
+    print '[WORKERS] Using %d workers' % workers
+    return workers
+
+def parse_workers(settings, values, default=None):
+    value = values.get('optional.workers', default)
+    if value is not None and value.lower() == 'false':
+        # False disables workers, prefork needs them and uses its default
+        value = default
+    if value == 'auto':
+        # Sized only when starting, the other actions must handle the
+        # workers that are running
+        if settings.action in ('start', 'restart', 'krestart'):
+            workers = auto_workers(settings, values)
+            save_workers_file(settings, workers=workers)
+            return workers
+        return load_workers_file(settings).get('workers', 1)
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        print "Invalid workers value. It has to be a number, 'auto' or 'False'."
+        sys.exit(1)
+
+def bind_reuseport(host, port, backlog=128):
+    """
+    Returns a listening socket on host and port that other processes, like
+    the workers started by a later rolling-restart, can bind too.
+    """
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
 def load_config(filename, settings):
     values = {}
 
@@ -458,6 +1166,15 @@ def load_config(filename, settings):
     if 'optional.nginx_tmpl' in values:
         settings.nginx_tmpl = values.get('optional.nginx_tmpl')
 
+    if values.get('optional.supervise', 'False').lower() != 'false':
+        settings.supervise = True
+
+    settings.prefork = (values.get('optional.prefork', 'False').lower()
+        != 'false')
+    settings.reuseport = (values.get('optional.reuseport', 'False').lower()
+        != 'false')
+    settings.workers = 1
+
     if values.get('database.uri') and not settings.database:
         parse = urlparse(values.get('database.uri'))
         settings.database = parse.path[1:]
@@ -468,15 +1185,32 @@ def load_config(filename, settings):
     if values.get('jasper.pid'):
         settings.pidfile_jasper = values.get('jasper.pid')
 
-    if (values.get('optional.workers', 'False') != 'False' and
+    if settings.prefork:
+        settings.doc_port = False
+        settings.workers = parse_workers(settings, values, '2')
+        # A single master process forks the workers, which share its
+        # listening sockets, so neither per worker ports nor nginx are used
+        settings.config_multiserver = False
+        settings.config_nginx = False
+        settings.nginx_contexts = {}
+    elif (settings.reuseport and
+            values.get('optional.workers', 'False') != 'False'):
+        settings.doc_port = False
+        settings.workers = parse_workers(settings, values)
+        # All workers use the configuration file and accept on one socket
+        # bound by server.py, the kernel balances the connections
+        settings.config_multiserver = False
+        settings.config_nginx = False
+        settings.nginx_contexts = {}
+        pidfile = values.get('optional.pidfile', settings.pidfiles[0])
+        settings.pidfiles = ['%s.%s' % (pidfile, w)
+            for w in range(1, settings.workers + 1)]
+    elif (values.get('optional.workers', 'False') != 'False' and
         values.get('optional.nginx_tmpl', 'False') != 'False'):
 
         settings.doc_port = values.get('optional.doc_port')
-        try:
-            workers = int(values['optional.workers'])
-        except:
-            print "Invalid workers value. It has to be a number or 'False'."
-            sys.exit(1)
+        workers = parse_workers(settings, values)
+        settings.workers = workers
 
         (settings.config_multiserver, settings.config_nginx) = (
             prepare_multiprocess(parser, values, filename, workers))
@@ -493,6 +1227,7 @@ def load_config(filename, settings):
     else:
         settings.config_multiserver = False
         settings.config_nginx = False
+        settings.nginx_contexts = {}
         settings.doc_port = False
 
     return values
@@ -503,6 +1238,9 @@ def prepare_multiprocess(parser, values, filename, workers):
     used_ports = {}
     configfile_names = []
     nginx_files = []
+    # Kept so the supervisor can render the files again with the ready
+    # workers only
+    settings.nginx_contexts = {}
     w = 1
     while w <= workers:
         configfile_name = "/tmp/%s.%s" % (filename, w)
@@ -510,11 +1248,8 @@ def prepare_multiprocess(parser, values, filename, workers):
         configfile_names.append(configfile_name)
         w += 1
     for (section, ports) in used_ports.items():
-        worker_processes = subprocess.check_output(
-            "grep processor /proc/cpuinfo | wc -l", shell=True)
-        worker_processes = re.match("[0-9]+", worker_processes).group(0)
         context = {
-            'worker_processes': worker_processes,
+            'worker_processes': cpu_count(),
             'pid': '/tmp/nginx.%s.pid' % ports['main'],
             'server_name': get_fqdn(),
             'servers': [],
@@ -541,6 +1276,8 @@ def prepare_multiprocess(parser, values, filename, workers):
         nginx_file = "/tmp/nginx.conf.%s" % ports['main']
         create_nginx_file(nginx_file, values['optional.nginx_tmpl'], context)
         nginx_files.append(nginx_file)
+        settings.nginx_contexts[section] = (nginx_file,
+            values['optional.nginx_tmpl'], context)
 
     return configfile_names, nginx_files
 
@@ -582,11 +1319,11 @@ def find_directory(root, directories):
             return path
     return None
 
-def start(settings):
+def worker_calls(settings):
     """
-    Starts Tryton server.
+    Returns the list of (call, pidfile, config file) of the Tryton server
+    workers and whether they run behind nginx.
     """
-
     server_directories = [
         'trytond',
         '.virtualenvs/monitoring',
@@ -602,11 +1339,49 @@ def start(settings):
     if settings.logconf:
         call += ['--logconf', settings.logconf]
 
-    if (not settings.config_multiserver or (settings.config_multiserver and
-            settings.extra_arguments and ('-u' in settings.extra_arguments
-            or '--all' in settings.extra_arguments))):
+    # (call, pidfile, config file) of each worker
+    workers = []
+    if settings.prefork:
+        call = ['python', '-u', os.path.join(os.path.dirname(
+                    os.path.realpath(__file__)), 'prefork.py'),
+            '--trytond', path, '-c', settings.config,
+            '--workers', str(settings.workers),
+            '--timeout', str(settings.timeout)]
+        if settings.reuseport:
+            call += ['--reuseport']
+        if settings.logconf:
+            call += ['--logconf', settings.logconf]
+        if settings.database:
+            call += ['--database', settings.database]
+        if settings.cron:
+            print '[PREFORK] Cron is not run by prefork workers.'
+        if settings.verbose:
+            print "Calling '%s'" % ' '.join(call)
+        workers.append((call, settings.pidfiles[0], settings.config))
+        return workers, False
+    update = bool(settings.extra_arguments and ('-u' in settings.extra_arguments
+            or '--all' in settings.extra_arguments))
+    multiserver = bool(settings.config_multiserver and not update)
+    if settings.reuseport and settings.workers > 1 and not update:
+        if settings.dev:
+            # Its reloader binds the address instead of using the socket
+            print '[REUSEPORT] Ignoring dev, it does not work with reuseport.'
+        for w, pidfile in enumerate(settings.pidfiles):
+            multicall = call + ['-c', settings.config]
+            if settings.database:
+                multicall += ['--database', settings.database]
+            if w == 0 and settings.cron:
+                multicall += [settings.cron]
+            if settings.verb:
+                multicall += [settings.verb]
+            if settings.verbose:
+                print "Calling '%s'" % ' '.join(multicall)
+            workers.append((multicall, pidfile, settings.config))
+    elif not multiserver:
+        config = None
         if os.path.exists(settings.config):
             call += ['-c', settings.config]
+            config = settings.config
         else:
             # If configuration file does not exist try to start the server anyway
             print 'Configuration file not found: %s' % settings.config
@@ -625,10 +1400,7 @@ def start(settings):
         if settings.verbose:
             print "Calling '%s'" % ' '.join(call)
 
-        # Create pidfile ourselves because if Tryton server crashes on start it may
-        # not have created the file yet while keeping the process running.
-        fork_and_call(call, pidfile=settings.pidfiles[0],
-            logfile=settings.logfile)
+        workers.append((call, settings.pidfiles[0], config))
     else:
         first = True
         for config in settings.config_multiserver:
@@ -651,8 +1423,81 @@ def start(settings):
             if settings.verbose:
                 print "Calling '%s'" % ' '.join(multicall)
 
-            fork_and_call(multicall, pidfile=settings.pidfiles[w],
-                logfile=settings.logfile)
+            workers.append((multicall, settings.pidfiles[w], config))
+    return workers, multiserver
+
+def shared_socket(settings, workers):
+    """
+    Binds the [web] listen address of the configuration file with
+    SO_REUSEPORT when several trytond processes must share it. Returns the
+    socket, the environment that makes werkzeug in trytond use it instead
+    of binding its own and the (fd, inode) that tells whether a worker
+    serves it, or (None, None, None).
+    """
+    if not (settings.reuseport and not settings.prefork and len(workers) > 1):
+        return None, None, None
+    addresses = listen_addresses(settings.config)
+    # Only the werkzeug server of [web] uses WERKZEUG_SERVER_FD, servers of
+    # other sections would bind the address themselves
+    if [x for x in addresses if x[0] != 'web'] or not addresses:
+        print ('[REUSEPORT] Only a [web] listen address can be shared, use '
+            'optional.prefork to share jsonrpc, xmlrpc or webdav ones.')
+        sys.exit(1)
+    _, host, port = addresses[0]
+    sock = bind_reuseport(host, int(port))
+    return (sock, dict(os.environ, WERKZEUG_SERVER_FD=str(sock.fileno())),
+        (sock.fileno(), os.fstat(sock.fileno()).st_ino))
+
+def serves_socket(pid, shared):
+    """
+    Tells whether process pid serves the shared socket: werkzeug duplicates
+    the inherited fd when it creates its server, so the socket is then open
+    on another fd. Probing the port would be answered by other workers.
+    """
+    fd, inode = shared
+    target = 'socket:[%d]' % inode
+    directory = '/proc/%d/fd' % pid
+    try:
+        for name in os.listdir(directory):
+            if name == str(fd):
+                continue
+            try:
+                if os.readlink(os.path.join(directory, name)) == target:
+                    return True
+            except OSError:
+                # Closed meanwhile
+                pass
+    except OSError:
+        pass
+    return False
+
+def start(settings):
+    """
+    Starts Tryton server.
+    """
+    workers, multiserver = worker_calls(settings)
+    # Workers inherit the socket, server.py does not need to keep it
+    sock, env, shared = shared_socket(settings, workers)
+    if settings.supervise:
+        fork_and_run(Supervisor(settings, workers,
+                settings.config_nginx if multiserver else [], env,
+                shared).run,
+            pidfile=settings.pidfile_supervisor, logfile=settings.logfile)
+        if sock:
+            sock.close()
+        return
+
+    for call, pidfile, config in workers:
+        # Create pidfile ourselves because if Tryton server crashes on start
+        # it may not have created the file yet while keeping the process
+        # running.
+        fork_and_call(call, pidfile=pidfile, logfile=settings.logfile,
+            env=env)
+    if sock:
+        sock.close()
+    save_worker_ports(settings, dict((pidfile, listen_ports(config)
+                if config else []) for _, pidfile, config in workers))
+    if multiserver:
         start_nginx(settings.config_nginx)
 
 def start_nginx(config_nginx):
@@ -660,12 +1505,13 @@ def start_nginx(config_nginx):
         nginxcall = ('/usr/sbin/nginx', '-c', nginx)
         subprocess.Popen(nginxcall, stdout=None, stderr=None)
 
-def stop(pidfiles, warning=True):
+def stop(pidfiles, warning=True, timeout=None):
     """
     Stops Tryton's application server/s and JasperServer.
 
     If warning=True it will show a message to the user when pid file does
-    not exist.
+    not exist. With timeout processes get SIGTERM and that many seconds to
+    stop before SIGKILL, so a prefork master can stop its workers.
     """
     for pidfile in pidfiles:
         if not pidfile:
@@ -680,7 +1526,10 @@ def stop(pidfiles, warning=True):
         except ValueError:
             continue
         try:
-            os.kill(pid, 9)
+            if timeout is not None and pid_running(pid):
+                terminate(pid, timeout)
+            else:
+                os.kill(pid, 9)
         except OSError:
             print ("Could not kill process with pid %d. Probably it's no "
                 "longer running." % pid)
@@ -695,7 +1544,561 @@ def stop_nginx(config_nginx):
         call = ('/usr/sbin/nginx', '-c', nginx, '-s', 'stop')
         subprocess.Popen(call, stdout=None, stderr=None)
 
+# Seconds between supervisor iterations, health probes of ready workers,
+# maximum time for a worker to accept connections, maximum restart delay
+# and time a worker must stay ready for its failures to be forgotten
+SUPERVISOR_INTERVAL = 0.5
+PROBE_INTERVAL = 5
+READY_TIMEOUT = 300
+BACKOFF_MAX = 60
+STABLE_TIME = 60
+# Seconds between removing a worker from the nginx upstreams and stopping it
+DRAIN_TIME = 2
+
+def listen_addresses(config_file):
+    """
+    Returns (section, host, port) of the listen addresses of the web,
+    jsonrpc, xmlrpc and webdav sections of a trytond configuration file.
+    """
+    parser = ConfigParser.ConfigParser()
+    parser.read([config_file])
+    addresses = []
+    for section in ('web', 'jsonrpc', 'xmlrpc', 'webdav'):
+        if parser.has_option(section, 'listen'):
+            host, port = parser.get(section, 'listen').rsplit(':', 1)
+            host = host.strip('[]')
+            if host == '*':
+                host = '0.0.0.0'
+            addresses.append((section, host, port))
+    return addresses
+
+def listen_ports(config_file):
+    """
+    Returns the listen addresses of config_file with the hosts to connect
+    to them.
+    """
+    return [(section, 'localhost' if host in ('', '0.0.0.0', '::') else host,
+            port) for section, host, port in listen_addresses(config_file)]
+
+def port_open(host, port, timeout=0.5):
+    try:
+        connection = socket.create_connection((host, int(port)), timeout)
+    except socket.error:
+        return False
+    connection.close()
+    return True
+
+def supervisor_command(settings, command, timeout=5):
+    """
+    Sends command to the supervisor status socket and returns its decoded
+    answer or None if no supervisor is running.
+    """
+    if not os.path.exists(settings.supervisor_socket):
+        return None
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.settimeout(timeout)
+    try:
+        connection.connect(settings.supervisor_socket)
+        connection.sendall(command + '\n')
+        data = []
+        while True:
+            chunk = connection.recv(65536)
+            if not chunk:
+                break
+            data.append(chunk)
+    except socket.error:
+        return None
+    finally:
+        connection.close()
+    return json.loads(''.join(data))
+
+class Supervisor(object):
+    """
+    Runs the trytond workers as child processes. Workers are ready once all
+    their ports accept connections, ready workers are probed every
+    PROBE_INTERVAL seconds and dead workers are started again after a delay
+    that doubles on each consecutive failure. nginx is started when the
+    first worker is ready and its upstreams only list ready workers. The
+    state is served as JSON on a unix socket.
+    """
+    def __init__(self, settings, workers, config_nginx, env=None,
+            shared=None):
+        self.settings = settings
+        self.config_nginx = config_nginx
+        self.env = env
+        self.shared = shared
+        self.workers = []
+        for number, (call, pidfile, config) in enumerate(workers, 1):
+            self.workers.append({
+                    'number': number,
+                    'call': call,
+                    'pidfile': pidfile,
+                    'ports': listen_ports(config) if config else [],
+                    'process': None,
+                    'state': 'stopped',
+                    'restarts': 0,
+                    'failures': 0,
+                    'started': None,
+                    'ready': None,
+                    'next_start': 0,
+                    'probed': 0,
+                    })
+        self.upstreams = None
+        self.nginx_started = False
+        self.running = True
+        # Workers waiting for a rolling restart and the one being restarted
+        self.rolling = []
+        self.restarting = None
+        # Worker whose restart aborted the last rolling restart
+        self.failed = None
+
+    def log(self, message):
+        print '%s [SUPERVISOR] %s' % (
+            datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), message)
+        sys.stdout.flush()
+
+    def start_worker(self, worker):
+        output = open(self.settings.logfile, 'a')
+        try:
+            worker['process'] = subprocess.Popen(worker['call'],
+                stdout=output, stderr=output, env=self.env)
+        finally:
+            output.close()
+        with open(worker['pidfile'], 'w') as f:
+            f.write(str(worker['process'].pid))
+        worker['state'] = 'starting'
+        worker['started'] = time.time()
+        worker['ready'] = None
+        self.log('Worker %d started with pid %d' % (worker['number'],
+                worker['process'].pid))
+
+    def probe(self, worker):
+        if self.shared:
+            return serves_socket(worker['process'].pid, self.shared)
+        return all(port_open(host, port) for _, host, port in worker['ports'])
+
+    def check(self, worker):
+        now = time.time()
+        if worker['state'] == 'draining':
+            if worker['process'].poll() is not None:
+                self.log('Worker %d drained' % worker['number'])
+                self.start_worker(worker)
+            elif now >= worker['deadline']:
+                self.log('Worker %d did not stop in %ds, killing it' % (
+                        worker['number'], self.settings.timeout))
+                worker['process'].kill()
+                worker['deadline'] = now + self.settings.timeout
+            elif not worker['terminated'] and now >= worker['next_start']:
+                worker['process'].terminate()
+                worker['terminated'] = True
+            return
+        if worker['state'] == 'backoff':
+            if now >= worker['next_start']:
+                self.start_worker(worker)
+            return
+        process = worker['process']
+        if process is None:
+            return
+        code = process.poll()
+        if code is not None:
+            if worker['ready'] and now - worker['ready'] >= STABLE_TIME:
+                worker['failures'] = 0
+            worker['failures'] += 1
+            worker['restarts'] += 1
+            delay = min(BACKOFF_MAX, 2 ** (worker['failures'] - 1))
+            worker['state'] = 'backoff'
+            worker['next_start'] = now + delay
+            worker['process'] = None
+            self.log('Worker %d (pid %d) exited with code %s, restarting in '
+                '%ds' % (worker['number'], process.pid, code, delay))
+        elif worker['state'] == 'starting':
+            if self.probe(worker):
+                worker['state'] = 'ready'
+                worker['ready'] = worker['probed'] = now
+                self.log('Worker %d ready in %.1fs' % (worker['number'],
+                        now - worker['started']))
+            elif now - worker['started'] > READY_TIMEOUT:
+                self.log('Worker %d not ready after %ds, killing it' % (
+                        worker['number'], READY_TIMEOUT))
+                process.kill()
+        elif now - worker['probed'] >= PROBE_INTERVAL:
+            worker['probed'] = now
+            healthy = self.probe(worker)
+            if worker['state'] == 'ready' and not healthy:
+                worker['state'] = 'unhealthy'
+                self.log('Worker %d does not accept connections' %
+                    worker['number'])
+            elif worker['state'] == 'unhealthy' and healthy:
+                worker['state'] = 'ready'
+                self.log('Worker %d accepts connections again' %
+                    worker['number'])
+
+    def update_nginx(self):
+        ready = [x for x in self.workers if x['state'] == 'ready']
+        upstreams = [x['number'] for x in ready]
+        if upstreams == self.upstreams or not self.config_nginx:
+            return
+        if not ready and not self.nginx_started:
+            return
+        self.upstreams = upstreams
+        write_upstreams(self.settings, sum((x['ports'] for x in ready), []))
+        if self.nginx_started:
+            reload_nginx(self.config_nginx)
+        else:
+            start_nginx(self.config_nginx)
+            self.nginx_started = True
+        self.log('Upstreams: workers %s' % (
+                ', '.join(str(x) for x in upstreams) or 'none'))
+
+    def roll(self):
+        """
+        Advances the rolling restart: the next worker is only drained when
+        the previous one is ready again so at most one worker is out of the
+        upstreams.
+        """
+        worker = self.restarting
+        if worker is not None:
+            if worker['state'] == 'ready':
+                self.log('Worker %d restarted' % worker['number'])
+                self.restarting = None
+            elif worker['state'] == 'backoff':
+                self.log('Worker %d failed to restart, rolling restart '
+                    'aborted' % worker['number'])
+                self.failed = worker['number']
+                self.restarting = None
+                self.rolling = []
+            return
+        while self.rolling:
+            worker = self.rolling.pop(0)
+            if worker['state'] != 'ready':
+                # Restarted by check() anyway
+                continue
+            worker['state'] = 'draining'
+            worker['terminated'] = False
+            # Give nginx time to reload without the worker before stopping it
+            worker['next_start'] = time.time() + DRAIN_TIME
+            worker['deadline'] = (worker['next_start']
+                + self.settings.timeout)
+            self.restarting = worker
+            self.log('Draining worker %d' % worker['number'])
+            self.update_nginx()
+            break
+
+    def status(self):
+        now = time.time()
+        return {
+            'pid': os.getpid(),
+            'rolling': [x['number'] for x in ([self.restarting]
+                    if self.restarting else []) + self.rolling],
+            'failed': self.failed,
+            'workers': [{
+                    'number': x['number'],
+                    'pid': x['process'].pid if x['process'] else None,
+                    'state': x['state'],
+                    'ports': [int(p) for _, _, p in x['ports']],
+                    'restarts': x['restarts'],
+                    'uptime': (int(now - x['started'])
+                        if x['process'] else None),
+                    } for x in self.workers],
+            }
+
+    def command(self, command):
+        if command == 'status':
+            return self.status()
+        if command == 'restart':
+            if self.restarting or self.rolling:
+                return {'error': 'A rolling restart is already running'}
+            self.rolling = self.workers[:]
+            self.failed = None
+            self.log('Rolling restart of %d workers' % len(self.rolling))
+            return self.status()
+        return {'error': 'Unknown command: %s' % command}
+
+    def serve(self, server):
+        connection, _ = server.accept()
+        try:
+            connection.settimeout(5)
+            command = connection.makefile('r').readline().strip()
+            connection.sendall(json.dumps(self.command(command or 'status')))
+        except socket.error:
+            pass
+        finally:
+            connection.close()
+
+    def stop(self, *args):
+        self.running = False
+
+    def shutdown(self):
+        self.log('Stopping workers')
+        for worker in self.workers:
+            if worker['process']:
+                worker['process'].terminate()
+        limit = time.time() + self.settings.timeout + 10
+        for worker in self.workers:
+            if not worker['process']:
+                continue
+            while worker['process'].poll() is None and time.time() < limit:
+                time.sleep(0.1)
+            if worker['process'].poll() is None:
+                worker['process'].kill()
+                worker['process'].wait()
+        for worker in self.workers:
+            if os.path.exists(worker['pidfile']):
+                os.remove(worker['pidfile'])
+        if self.nginx_started:
+            stop_nginx(self.config_nginx)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        if os.path.exists(self.settings.supervisor_socket):
+            os.remove(self.settings.supervisor_socket)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.settings.supervisor_socket)
+        server.listen(5)
+        self.log('Supervising %d workers' % len(self.workers))
+        try:
+            for worker in self.workers:
+                self.start_worker(worker)
+            while self.running:
+                for worker in self.workers:
+                    self.check(worker)
+                self.roll()
+                self.update_nginx()
+                try:
+                    readable, _, _ = select.select([server], [], [],
+                        SUPERVISOR_INTERVAL)
+                except select.error:
+                    # Interrupted by a signal
+                    continue
+                if readable:
+                    self.serve(server)
+        finally:
+            server.close()
+            os.remove(self.settings.supervisor_socket)
+            self.shutdown()
+            self.log('Stopped')
+
+def write_upstreams(settings, ports):
+    """
+    Renders the nginx files with the (section, host, port) of ports as
+    upstream servers.
+    """
+    for section, (nginx_file, template, context) in (
+            settings.nginx_contexts.items()):
+        servers = [{
+                'host': 'localhost',
+                'port': port,
+                } for section_, _, port in ports if section_ == section]
+        # nginx refuses empty upstreams, keep all so it answers 502
+        create_nginx_file(nginx_file, template, dict(context,
+                servers=servers or context['servers']))
+
+def reload_nginx(config_nginx):
+    for nginx in config_nginx:
+        subprocess.call(('/usr/sbin/nginx', '-c', nginx, '-s', 'reload'))
+
+def load_workers_file(settings):
+    if not os.path.exists(settings.workers_file):
+        return {}
+    with open(settings.workers_file, 'r') as f:
+        return json.load(f)
+
+def save_workers_file(settings, **values):
+    data = load_workers_file(settings)
+    data.update(values)
+    with open(settings.workers_file, 'w') as f:
+        json.dump(data, f)
+
+def save_worker_ports(settings, ports):
+    """
+    Stores the ports each worker listens on, the configuration files are
+    written again with new ports on each server.py execution.
+    """
+    save_workers_file(settings, ports=ports)
+
+def load_worker_ports(settings):
+    return dict((pidfile, [tuple(x) for x in ports])
+        for pidfile, ports in load_workers_file(settings).get('ports',
+            {}).items())
+
+def read_pid(pidfile):
+    try:
+        return int(open(pidfile, 'r').read())
+    except (IOError, ValueError):
+        return None
+
+def pid_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+def terminate(pid, timeout):
+    """
+    Sends SIGTERM to pid and SIGKILL if it is still running after timeout
+    seconds.
+    """
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except OSError:
+        return
+    limit = time.time() + timeout
+    while pid_running(pid) and time.time() < limit:
+        time.sleep(0.2)
+    if pid_running(pid):
+        print 'Worker %d did not stop in %ds, killing it.' % (pid, timeout)
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+def wait_ready(ports, pid, shared=None, timeout=READY_TIMEOUT):
+    limit = time.time() + timeout
+    while time.time() < limit:
+        if pid is not None and not pid_running(pid):
+            return False
+        if shared:
+            if pid is not None and serves_socket(pid, shared):
+                return True
+        elif all(port_open(host, port) for _, host, port in ports):
+            return True
+        time.sleep(SUPERVISOR_INTERVAL)
+    return False
+
+def rolling_restart(settings):
+    """
+    Restarts the workers one at a time. Each worker is removed from the
+    nginx upstreams, stopped, started again and added back once its ports
+    accept connections, so capacity never drops by more than one worker.
+    With a supervisor running the restart is delegated to it.
+    """
+    if settings.prefork:
+        # Workers forked again by the master would run the code it loaded
+        print ('rolling-restart is not supported with prefork, restarting '
+            'the master stops the whole service. Use restart.')
+        return False
+    status = supervisor_command(settings, 'restart')
+    if status is not None:
+        if 'error' in status:
+            print status['error']
+            return False
+        pending = status['rolling']
+        while pending:
+            time.sleep(1)
+            status = supervisor_command(settings, 'status')
+            if status is None:
+                print 'Supervisor stopped during the rolling restart.'
+                return False
+            if status['failed'] is not None:
+                print ('Worker %d failed to restart, rolling restart '
+                    'aborted.' % status['failed'])
+                return False
+            if status['rolling'] != pending:
+                for number in pending[:len(pending) - len(status['rolling'])]:
+                    print 'Worker %d restarted.' % number
+                pending = status['rolling']
+        return True
+
+    workers, multiserver = worker_calls(settings)
+    current = load_worker_ports(settings)
+    if not current:
+        print 'Worker ports not found, use start or restart first.'
+        return False
+    # With SO_REUSEPORT the new workers get a new socket while the old ones
+    # keep accepting on theirs
+    sock, env, shared = shared_socket(settings, workers)
+    try:
+        return _rolling_restart(settings, workers, multiserver, current, env,
+            shared)
+    finally:
+        if sock:
+            sock.close()
+
+def _rolling_restart(settings, workers, multiserver, current, env, shared):
+    for call, pidfile, config in workers:
+        ports = listen_ports(config) if config else []
+        others = sum((v for k, v in current.items() if k != pidfile), [])
+        if multiserver:
+            write_upstreams(settings, others)
+            reload_nginx(settings.config_nginx)
+            time.sleep(DRAIN_TIME)
+        pid = read_pid(pidfile)
+        if pid is not None:
+            terminate(pid, settings.timeout)
+        if os.path.exists(pidfile):
+            os.remove(pidfile)
+        fork_and_call(call, pidfile=pidfile, logfile=settings.logfile,
+            env=env)
+        wait_for_file(pidfile)
+        started = time.time()
+        if not wait_ready(ports, read_pid(pidfile), shared):
+            # Keep it out of the upstreams, the rest still serve requests
+            current.pop(pidfile, None)
+            save_worker_ports(settings, current)
+            print 'Worker %s is not ready, rolling restart aborted.' % pidfile
+            return False
+        current[pidfile] = ports
+        save_worker_ports(settings, current)
+        if multiserver:
+            write_upstreams(settings, sum(current.values(), []))
+            reload_nginx(settings.config_nginx)
+        print 'Worker %s restarted in %.1fs.' % (pidfile,
+            time.time() - started)
+    return True
+
+def stop_supervisor(settings, timeout=None):
+    """
+    Stops the supervisor, which stops its workers and nginx. Returns False
+    if no supervisor was running.
+    """
+    if timeout is None:
+        # Longer than the supervisor waits for its workers
+        timeout = settings.timeout + 20
+    if not os.path.exists(settings.pidfile_supervisor):
+        return False
+    try:
+        pid = int(open(settings.pidfile_supervisor, 'r').read())
+        os.kill(pid, signal.SIGTERM)
+    except (ValueError, OSError):
+        os.remove(settings.pidfile_supervisor)
+        return False
+    limit = time.time() + timeout
+    while os.path.exists(settings.pidfile_supervisor) and time.time() < limit:
+        time.sleep(0.2)
+    if os.path.exists(settings.pidfile_supervisor):
+        print 'Supervisor %d did not stop, killing it.' % pid
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+        os.remove(settings.pidfile_supervisor)
+        return False
+    return True
+
+def print_supervisor_status(settings):
+    status = supervisor_command(settings, 'status')
+    if not status:
+        return
+    print 'Supervisor %d' % status['pid']
+    table = [['Worker', 'Pid', 'State', 'Ports', 'Restarts', 'Uptime']]
+    for worker in status['workers']:
+        table.append([str(worker['number']), worker['pid'] or '-',
+                worker['state'], ','.join(str(x) for x in worker['ports']),
+                worker['restarts'], format_age(worker['uptime'])])
+    pprint_table(table)
+
+def wait_for_file(filename, timeout=30):
+    limit = time.time() + timeout
+    while not os.path.exists(filename) and time.time() < limit:
+        time.sleep(0.1)
+    return os.path.exists(filename)
+
 def tail(filename, settings):
+    if not wait_for_file(filename):
+        print 'Log file %s not found.' % filename
+        return True
     file = open(filename, 'r')
     try:
         while 1:
@@ -765,10 +2168,18 @@ if settings.action == 'ps':
     ps()
 
 if settings.action == 'db':
-    db()
+    db(settings)
 
 config = load_config(settings.config, settings)
 
+if settings.action == 'queries':
+    queries(settings, config)
+    sys.exit(0)
+
+if settings.action == 'indexes':
+    indexes(settings, config)
+    sys.exit(0)
+
 if settings.action == 'top':
     for pidfile in settings.pidfiles:
         top(pidfile)
@@ -788,7 +2199,14 @@ if settings.action in ('start', 'restart', 'krestart'):
         print "No user documentation available."
 
 if settings.action in ('stop', 'restart', 'krestart'):
-    stop(settings.pidfiles)
+    if not stop_supervisor(settings):
+        # The prefork master needs its workers' timeout plus its own wait
+        stop(settings.pidfiles, timeout=settings.timeout + 10
+            if settings.prefork else None)
+        # On restart workers = auto may have sized fewer workers than the
+        # running ones
+        stop(sorted(set(load_worker_ports(settings)) - set(settings.pidfiles)),
+            warning=False)
     stop([settings.pidfile_jasper], warning=False)
     kill_process('celery', 'celery')
     if settings.config_nginx:
@@ -797,13 +2215,18 @@ if settings.action in ('stop', 'restart', 'krestart'):
 if settings.action in ('kill', 'krestart'):
     kill()
 
+if settings.action == 'memory':
+    memory(settings)
+    sys.exit(0)
+
+if settings.action == 'rolling-restart':
+    sys.exit(0 if rolling_restart(settings) else 1)
+
 if settings.action in ('start', 'restart', 'krestart'):
     backup_and_remove(settings.logfile)
     start(settings)
 
     if settings.tail:
-        # Ensure server.log has been created before executing 'tail'
-        time.sleep(1)
         tail_out = tail(settings.logfile, settings)
 
         if not tail_out:
@@ -814,4 +2237,6 @@ if settings.action in ('start', 'restart', 'krestart'):
             tail(settings.logfile, settings)
 
 if settings.action == 'status':
-    tail(settings.logfile, settings)
+    print_supervisor_status(settings)
+    if settings.tail:
+        tail(settings.logfile, settings)
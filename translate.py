@@ -21,17 +21,230 @@
 import os
 import sys
 import glob
+import time
 import polib
+import threading
+import subprocess
+import multiprocessing
 from optparse import OptionParser
 import uuid
-from common import Settings, check_output
+import hashlib
+import sqlite3
+import difflib
+from common import Settings, check_output, iter_po
 import re
 
 
+def normalize(text):
+    return ' '.join(text.split())
+
+
+def trigrams(text):
+    text = '  %s ' % text.lower()
+    return set(text[i:i + 3] for i in xrange(len(text) - 2))
+
+
+# Grams of a lookup kept under SQLite's limit of 999 host parameters, as
+# the fuzzy query uses them twice, and entries compared at most per lookup
+MAX_GRAMS = 400
+MAX_CANDIDATES = 200
+
+
+class TranslationMemory:
+    '''
+    Persistent SQLite translation memory of the translated entries of all
+    modules/*/locale/<lang>.po files.
+
+    Entries are keyed by their whitespace normalized msgid and indexed by
+    trigrams for fuzzy lookups. PO files are only parsed again when their
+    modification time or size and their content hash change.
+
+    Fuzzy lookups only take candidates from the rarest trigrams of the
+    text, as any entry sharing enough trigrams must contain one of them,
+    so common trigrams never make a lookup scan most of the memory.
+    '''
+    def __init__(self, filename, lang, ratio=0.85):
+        self.lang = lang
+        self.ratio = ratio
+        self.connection = sqlite3.connect(filename)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS source (path TEXT PRIMARY KEY,
+                mtime REAL, size INTEGER, hash TEXT);
+            CREATE TABLE IF NOT EXISTS entry (id INTEGER PRIMARY KEY,
+                lang TEXT, path TEXT, key TEXT, msgstr TEXT,
+                fuzzy INTEGER);
+            CREATE INDEX IF NOT EXISTS entry_key ON entry (lang, key);
+            CREATE INDEX IF NOT EXISTS entry_path ON entry (path);
+            CREATE TABLE IF NOT EXISTS trigram (gram TEXT, lang TEXT,
+                entry INTEGER);
+            CREATE INDEX IF NOT EXISTS trigram_gram ON trigram (lang, gram);
+            CREATE INDEX IF NOT EXISTS trigram_entry ON trigram (entry);
+            CREATE TABLE IF NOT EXISTS gram_count (lang TEXT, gram TEXT,
+                count INTEGER, PRIMARY KEY (lang, gram));
+            ''')
+        self.stats = {
+            'exact': 0,
+            'fuzzy': 0,
+            'miss': 0,
+            }
+
+    def update(self, glob_path):
+        '''
+        Loads the PO files matching glob_path that changed since the last
+        update. Returns the number of files loaded.
+        '''
+        cursor = self.connection.cursor()
+        loaded = 0
+        for path in glob.glob(glob_path):
+            stat = os.stat(path)
+            cursor.execute('SELECT mtime, size, hash FROM source '
+                'WHERE path = ?', (path,))
+            row = cursor.fetchone()
+            if row and row[:2] == (stat.st_mtime, stat.st_size):
+                continue
+            with open(path, 'rb') as f:
+                digest = hashlib.md5(f.read()).hexdigest()
+            cursor.execute('INSERT OR REPLACE INTO source '
+                '(path, mtime, size, hash) VALUES (?, ?, ?, ?)',
+                (path, stat.st_mtime, stat.st_size, digest))
+            if row and row[2] == digest:
+                continue
+            self._load(cursor, path)
+            loaded += 1
+        cursor.execute('SELECT 1 FROM gram_count WHERE lang = ? LIMIT 1',
+            (self.lang,))
+        if loaded or not cursor.fetchone():
+            cursor.execute('DELETE FROM gram_count WHERE lang = ?',
+                (self.lang,))
+            cursor.execute('INSERT INTO gram_count (lang, gram, count) '
+                'SELECT lang, gram, COUNT(*) FROM trigram WHERE lang = ? '
+                'GROUP BY gram', (self.lang,))
+        self.connection.commit()
+        return loaded
+
+    def _load(self, cursor, path):
+        cursor.execute('DELETE FROM trigram WHERE entry IN '
+            '(SELECT id FROM entry WHERE path = ?)', (path,))
+        cursor.execute('DELETE FROM entry WHERE path = ?', (path,))
+        for entry in iter_po(path):
+            if (not entry.msgid or not entry.msgstr
+                    or entry.msgid == entry.msgstr):
+                continue
+            key = normalize(entry.msgid)
+            cursor.execute('INSERT INTO entry (lang, path, key, msgstr, '
+                'fuzzy) VALUES (?, ?, ?, ?, ?)', (self.lang, path, key,
+                    entry.msgstr, 'fuzzy' in entry.flags))
+            id = cursor.lastrowid
+            cursor.executemany('INSERT INTO trigram (gram, lang, entry) '
+                'VALUES (?, ?, ?)', [(gram, self.lang, id)
+                    for gram in trigrams(key)])
+
+    def lookup(self, msgid):
+        '''
+        Returns (msgstr, fuzzy) for msgid or None. Exact matches keep the
+        fuzzy state of the source entry, similar ones are always fuzzy.
+        '''
+        key = normalize(msgid)
+        cursor = self.connection.cursor()
+        cursor.execute('SELECT msgstr, fuzzy FROM entry '
+            'WHERE lang = ? AND key = ? ORDER BY fuzzy LIMIT 1',
+            (self.lang, key))
+        row = cursor.fetchone()
+        if row:
+            self.stats['exact'] += 1
+            return row[0], bool(row[1])
+
+        grams = sorted(trigrams(key))[:MAX_GRAMS]
+        # Candidates must share at least ratio of the trigrams so they
+        # contain one of the len(grams) - need + 1 rarest ones
+        need = int(len(grams) * self.ratio)
+        cursor.execute('SELECT gram, count FROM gram_count '
+            'WHERE lang = ? AND gram IN (%s)' % ','.join('?' * len(grams)),
+            [self.lang] + grams)
+        counts = dict(cursor.fetchall())
+        rare = [x for x in sorted(grams, key=lambda x: counts.get(x, 0))[
+                :len(grams) - need + 1] if x in counts]
+        # A ratio of SequenceMatcher is at most 2 * shortest / total length
+        minimum = int(len(key) * self.ratio / (2 - self.ratio))
+        maximum = int(len(key) * (2 - self.ratio) / self.ratio) + 1
+        rows = []
+        if rare:
+            # Unary + keeps SQLite from scanning the trigrams of the language
+            # through trigram_gram instead of reading the candidates' ones
+            cursor.execute('SELECT e.key, e.msgstr FROM trigram t '
+                'JOIN entry e ON e.id = t.entry '
+                'WHERE +t.lang = ? AND +t.gram IN (%s) AND t.entry IN ('
+                    'SELECT DISTINCT r.entry FROM trigram r '
+                    'JOIN entry c ON c.id = r.entry '
+                    'WHERE r.lang = ? AND r.gram IN (%s) '
+                        'AND LENGTH(c.key) BETWEEN ? AND ? LIMIT ?) '
+                'GROUP BY t.entry HAVING COUNT(*) >= ? '
+                'ORDER BY COUNT(*) DESC LIMIT 10' % (
+                    ','.join('?' * len(grams)), ','.join('?' * len(rare))),
+                [self.lang] + grams + [self.lang] + rare
+                + [minimum, maximum, MAX_CANDIDATES, need])
+            rows = cursor.fetchall()
+        best = None
+        for candidate, msgstr in rows:
+            ratio = difflib.SequenceMatcher(None, key, candidate).ratio()
+            if ratio >= self.ratio and (not best or ratio > best[0]):
+                best = (ratio, msgstr)
+        if best:
+            self.stats['fuzzy'] += 1
+            return best[1], True
+        self.stats['miss'] += 1
+        return None
+
+    def close(self):
+        self.connection.close()
+
+
+class ApertiumPipeline:
+    '''
+    Long-lived apertium process in null-flush mode (-z): each text written
+    terminated by a NUL character is answered with its translation
+    terminated by NUL, so one process translates any number of entries.
+    '''
+    def __init__(self, lang):
+        self.process = subprocess.Popen(['apertium', '-z', '-m',
+                lang + '.tmx', '-u', lang], stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE)
+        self.buffer = ''
+
+    def _write(self, texts):
+        for text in texts:
+            self.process.stdin.write(text.encode('utf-8') + '\0')
+            self.process.stdin.flush()
+
+    def _read(self):
+        while not '\0' in self.buffer:
+            data = os.read(self.process.stdout.fileno(), 65536)
+            if not data:
+                raise IOError('apertium pipeline closed unexpectedly')
+            self.buffer += data
+        text, self.buffer = self.buffer.split('\0', 1)
+        return unicode(text, 'utf-8')
+
+    def translate_many(self, texts):
+        # Write from a thread so apertium is never blocked on a full output
+        # pipe while we are still writing its input
+        writer = threading.Thread(target=self._write, args=(texts,))
+        writer.start()
+        translations = [self._read() for _ in texts]
+        writer.join()
+        return translations
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
 class ApertiumTranslator:
-    def __init__(self, target, source='en'):
+    def __init__(self, target, source='en', jobs=None):
         self.source = source
         self.target = target
+        self.jobs = jobs or multiprocessing.cpu_count()
+        self.pipelines = []
 
     def translate(self, text):
         lang = '%s-%s' % (self.source, self.target)
@@ -39,46 +252,242 @@ class ApertiumTranslator:
             '-u', lang], text)
         return translation
 
-    def translate_po(self, filename, entries='missing'):
-        print filename
+    def translate_many(self, texts):
+        '''
+        Translates texts through self.jobs persistent apertium pipelines
+        running in parallel. Pipelines are started on first use and kept
+        until close() is called.
+        '''
+        if not texts:
+            return []
+        lang = '%s-%s' % (self.source, self.target)
+        jobs = min(self.jobs, len(texts))
+        while len(self.pipelines) < jobs:
+            self.pipelines.append(ApertiumPipeline(lang))
+
+        chunks = [texts[i::jobs] for i in xrange(jobs)]
+        results = [None] * jobs
+
+        def run(i):
+            results[i] = self.pipelines[i].translate_many(chunks[i])
+        threads = [threading.Thread(target=run, args=(i,))
+            for i in xrange(jobs)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        translations = [None] * len(texts)
+        for i in xrange(jobs):
+            translations[i::jobs] = results[i]
+        return translations
+
+    def close(self):
+        for pipeline in self.pipelines:
+            pipeline.close()
+        self.pipelines = []
+
+    def translate_po(self, filename, entries='missing', batch=True,
+            memory=None, verbose=True):
+        '''
+        Translates the entries of a PO file, saving it atomically. Returns a
+        dictionary with the number of entries translated by apertium, taken
+        from the translation memory (cached) and failed.
+        '''
+        if verbose:
+            print filename
         assert entries in ('missing', 'all'), 'entries parameter must be '\
                 '"missing" or "all"'
 
         po = polib.pofile(filename)
         if entries == 'missing':
             # Includes fuzzy entries
-            entries = po.untranslated_entries
+            entries = po.untranslated_entries()
+        else:
+            entries = [e for e in po if not e.obsolete]
+
+        pending = []
+        for entry in entries:
+            found = memory.lookup(entry.msgid) if memory else None
+            if found:
+                entry.msgstr, fuzzy = found
+                if fuzzy and not 'fuzzy' in entry.flags:
+                    entry.flags.append('fuzzy')
+                elif not fuzzy and 'fuzzy' in entry.flags:
+                    entry.flags.remove('fuzzy')
+            else:
+                pending.append(entry)
+
+        start = time.time()
+        if batch:
+            translations = self.translate_many([e.msgid for e in pending])
         else:
-            po
-        for entry in po:
-            print entry.msgid, entry.msgstr
-            entry.msgstr = self.translate(entry.msgid)
+            translations = [self.translate(e.msgid) for e in pending]
+        elapsed = time.time() - start
+
+        failed = 0
+        for entry, translation in zip(pending, translations):
+            if verbose:
+                print entry.msgid, translation
+            if not translation.strip():
+                failed += 1
+                continue
+            entry.msgstr = translation
             if not 'fuzzy' in entry.flags:
                 entry.flags.append('fuzzy')
-        po.save()
+        # Save to a temporary file and rename so an interrupted run never
+        # leaves a truncated PO file
+        po.save(filename + '.tmp')
+        os.rename(filename + '.tmp', filename)
+
+        result = {
+            'translated': len(pending) - failed,
+            'cached': len(entries) - len(pending),
+            'failed': failed,
+            }
+        if not verbose:
+            return result
+        print "* %d entries in %.2fs (%.1f entries/s, %s)" % (len(pending),
+            elapsed, len(pending) / elapsed if elapsed else 0,
+            'batch' if batch else 'one process per entry')
+        if memory:
+            hits = result['cached']
+            print ("* Translation memory: %d exact, %d fuzzy, %d misses "
+                "(%.0f%% hit rate)" % (memory.stats['exact'],
+                    memory.stats['fuzzy'], memory.stats['miss'],
+                    100.0 * hits / len(entries) if entries else 0))
+            if pending:
+                print "* Estimated time saved: %.2fs" % (
+                    hits * elapsed / len(pending))
+        return result
+
+
+# Translators of the current worker process, one per language, so apertium
+# pipelines and translation memory connections are reused between files
+_backends = {}
+
+
+def _translate_file(args):
+    module, lang, settings = args
+    if not lang in _backends:
+        memory = None
+        if settings.memory:
+            memory = TranslationMemory(settings.memory, lang)
+        _backends[lang] = (ApertiumTranslator(lang.split('_')[0],
+                jobs=settings.jobs or 1), memory)
+    translator, memory = _backends[lang]
+    locale_file = os.path.join(os.getcwd(), 'modules', module, 'locale',
+        lang + '.po')
+    try:
+        result = translator.translate_po(locale_file, batch=settings.batch,
+            memory=memory, verbose=False)
+    except Exception, e:
+        result = {
+            'translated': 0,
+            'cached': 0,
+            'failed': 0,
+            'error': str(e),
+            }
+    return module, lang, result
+
+
+def translate_all(settings):
+    '''
+    Translates every (module, language) pair on a process pool and prints a
+    summary table.
+    '''
+    if settings.all_modules:
+        modules = sorted(os.path.basename(os.path.dirname(x)) for x in
+            glob.glob(os.path.join(os.getcwd(), 'modules', '*', 'locale')))
+    else:
+        modules = [settings.module]
+    tasks = [(module, lang, settings) for lang in settings.langs
+        for module in modules if os.path.exists(os.path.join(os.getcwd(),
+                'modules', module, 'locale', lang + '.po'))]
+
+    if settings.memory:
+        # Update the memory before forking so workers only read it
+        for lang in settings.langs:
+            memory = TranslationMemory(settings.memory, lang)
+            loaded = memory.update(os.path.join(os.getcwd(), 'modules', '*',
+                    'locale', lang + '.po'))
+            memory.close()
+            print "* Translation memory %s: %d files updated" % (lang,
+                loaded)
+
+    start = time.time()
+    pool = multiprocessing.Pool(settings.processes)
+    try:
+        results = sorted(pool.imap_unordered(_translate_file, tasks))
+    finally:
+        pool.close()
+        pool.join()
+
+    table = [('Module', 'Lang', 'Translated', 'Cached', 'Failed')]
+    totals = [0, 0, 0]
+    for module, lang, result in results:
+        row = [result['translated'], result['cached'], result['failed']]
+        if 'error' in result:
+            row[2] = 'error'
+            print "* %s (%s): %s" % (module, lang, result['error'])
+        table.append((module, lang) + tuple(row))
+        for i in xrange(3):
+            if isinstance(row[i], int):
+                totals[i] += row[i]
+    table.append(('Total', '') + tuple(totals))
+    widths = [max(len(str(row[i])) for row in table)
+        for i in xrange(len(table[0]))]
+    for row in table:
+        print '  '.join(str(value).ljust(widths[i]) if i < 2
+            else str(value).rjust(widths[i]) for i, value in enumerate(row))
+    print "* %d files translated in %.2fs" % (len(tasks), time.time() - start)
 
 
 def parse_arguments(arguments):
-    usage = 'translate.py  -m <module> -l <lang>'
+    usage = ('translate.py  -m <module> -l <lang>\n'
+        '       translate.py  --all-modules --langs <lang>[,<lang>...]')
     parser = OptionParser(usage=usage)
     parser.add_option('-g', '--generate-tmx', dest='tmx', action="store_true",
         default=False)
     parser.add_option('-m', '--module', dest='module')
     parser.add_option('-l', '--lang', dest='lang')
+    parser.add_option('', '--all-modules', dest='all_modules',
+        action='store_true', default=False,
+        help='Translate all modules with a locale directory')
+    parser.add_option('', '--langs', dest='langs',
+        help='Comma separated list of languages')
+    parser.add_option('-p', '--processes', dest='processes', type='int',
+        default=multiprocessing.cpu_count(),
+        help='Number of (module, lang) pairs translated in parallel')
+    parser.add_option('-j', '--jobs', dest='jobs', type='int',
+        help='Number of apertium pipelines, one per core by default')
+    parser.add_option('', '--no-batch', dest='batch', action='store_false',
+        default=True, help='Start one apertium process per entry')
+    parser.add_option('', '--memory', dest='memory',
+        default='translation-memory.sqlite',
+        help='Translation memory consulted before apertium')
+    parser.add_option('', '--no-memory', dest='memory', action='store_const',
+        const=None, help='Do not use the translation memory')
 
     (option, arguments) = parser.parse_args(arguments)
 
     settings = Settings()
 
-    if option.module and option.lang:
-        settings.module = option.module
-        settings.lang = option.lang
-    else:
+    settings.langs = option.langs.split(',') if option.langs else (
+        [option.lang] if option.lang else [])
+    settings.lang = settings.langs[0] if settings.langs else None
+    settings.module = option.module
+    settings.all_modules = option.all_modules
+    settings.processes = option.processes
+    if not (option.module or option.all_modules) or not settings.langs:
         print usage
 
     settings.tmx = False
     if option.tmx:
         settings.tmx = True
+    settings.jobs = option.jobs
+    settings.batch = option.batch
+    settings.memory = option.memory
 
     return settings
 
@@ -101,26 +510,27 @@ def make_translation_memory(lang):
     }
 
     for src_file in glob.glob(glob_path):
-        pot = polib.pofile(src_file)
-        entries += pot.translated_entries()
-        entries += pot.fuzzy_entries()
-        entries += pot.obsolete_entries()
+        for record in iter_po(src_file):
+            if record.msgid and (record.obsolete or record.fuzzy
+                    or record.translated()):
+                entries.append(record.to_polib())
 
-    terms = []
+    terms = set()
     for e in entries:
         if e.msgid == e.msgstr:
             continue
+        term = (e.msgid, e.msgstr)
+        if term in terms:
+            continue
+        terms.add(term)
+
         keys = re.findall('\%\(\w+\)s',e.msgid)
         for key in keys:
             po.append(polib.POEntry(
                 msgid=key,
                 msgstr=key))
 
-        term = (e.msgid, e.msgstr)
-        if term not in terms:
-            terms.append(term)
-
-        if e.flags:
+        if 'fuzzy' in e.flags:
             e.flags.remove('fuzzy')
         po.append(e)
     po.save(dst_file)
@@ -134,14 +544,31 @@ if __name__ == "__main__":
 
     if settings.tmx:
         print "* Generating tmx memmory file..."
-        make_translation_memory(settings.lang)
+        for lang in settings.langs:
+            make_translation_memory(lang)
         print "* Finish tmx"
 
+    if settings.all_modules or len(settings.langs) > 1:
+        translate_all(settings)
+        print "* Please, Remember to upadte to module to update terms"
+        sys.exit(0)
+
     print "* Start translation module:", settings.module
     locale_dir = os.path.join(os.getcwd(), 'modules', settings.module,
         'locale')
     locale_file = os.path.join(locale_dir, settings.lang + '.po')
-    ap = ApertiumTranslator(settings.lang.split('_')[0])
-    ap.translate_po(locale_file)
+    memory = None
+    if settings.memory:
+        memory = TranslationMemory(settings.memory, settings.lang)
+        loaded = memory.update(os.path.join(os.getcwd(), 'modules', '*',
+                'locale', settings.lang + '.po'))
+        print "* Translation memory: %d files updated" % loaded
+    ap = ApertiumTranslator(settings.lang.split('_')[0], jobs=settings.jobs)
+    try:
+        ap.translate_po(locale_file, batch=settings.batch, memory=memory)
+    finally:
+        ap.close()
+        if memory:
+            memory.close()
     print "* Translation finished"
     print "* Please, Remember to upadte to module to update terms"